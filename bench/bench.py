@@ -0,0 +1,395 @@
+"""Офлайн-бенчмарк обработчиков бота.
+
+Прогоняет синтетический поток Update через настоящие обработчики из bot.py
+на локальной заглушке Bot API и хранилище в памяти (или одноразовом
+PostgreSQL) и печатает p50/p95/p99 задержки, обновлений в секунду и число
+обращений к БД на обновление.
+
+    python bench/bench.py --episodes 10,1000,100000 --updates 5000
+    python bench/bench.py --database-url postgresql://localhost/bench_db
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import logging
+import itertools
+from collections import defaultdict
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_api import StubBotAPI
+
+EPISODES_PER_TITLE = 24
+ADMIN_ID = 1
+
+# Доля каждого сценария в потоке обновлений
+SCENARIOS = {
+    'menu': 10,
+    'menu_page': 10,
+    'anime_details': 25,
+    'episodes_page': 10,
+    'watch_episode': 40,
+    'receive_episode_data': 5,
+    'admin_stats': 1,
+    'search': 3,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--episodes', default='10,1000,100000',
+                        help='размеры каталога в сериях через запятую')
+    parser.add_argument('--updates', type=int, default=2000, help='обновлений на один прогон')
+    parser.add_argument('--users', type=int, default=500, help='число разных пользователей')
+    parser.add_argument('--concurrency', type=int, default=8, help='UPDATE_CONCURRENCY бота')
+    parser.add_argument('--api-delay', type=float, default=0.0,
+                        help='задержка ответа заглушки Bot API, сек')
+    parser.add_argument('--database-url', help='одноразовая БД PostgreSQL; все таблицы будут очищены')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', dest='json_path', help='сохранить результаты в JSON')
+    return parser.parse_args()
+
+def prepare_environment(args, api_url):
+    """Окружение для bot.py нужно задать до импорта модуля."""
+    os.environ['BOT_TOKEN'] = '1:bench'
+    os.environ['DATABASE_URL'] = args.database_url or 'sqlite://memory'
+    os.environ['BOT_API_URL'] = api_url
+    os.environ['UPDATE_CONCURRENCY'] = str(args.concurrency)
+    os.environ['PERSISTENCE_BACKEND'] = 'none'
+    os.environ.setdefault('DB_SSLMODE', 'disable')
+
+# ===================== Каталог =====================
+def _seed_rows(episodes):
+    titles = max(1, -(-episodes // EPISODES_PER_TITLE))
+    anime_rows = [
+        (f"Аниме {i:06d}", f"Описание аниме {i}", f"https://example.com/covers/{i}.jpg")
+        for i in range(1, titles + 1)
+    ]
+    episode_rows = []
+    for n in range(episodes):
+        anime_id = n // EPISODES_PER_TITLE + 1
+        number = n % EPISODES_PER_TITLE + 1
+        # Половина серий — ссылки, половина — уже загруженные в Telegram видео
+        file_id = f"video-seed-{n}" if n % 2 else None
+        episode_rows.append((anime_id, number, f"https://vk.com/video-1_{n}", file_id))
+    return anime_rows, episode_rows
+
+def _seed(conn, anime_rows, episode_rows):
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM episodes")
+        cursor.execute("DELETE FROM anime")
+        cursor.execute("DELETE FROM users")
+        cursor.executemany(
+            "INSERT INTO anime (id, title, description, cover_url) VALUES (%s, %s, %s, %s)",
+            [(i, *row) for i, row in enumerate(anime_rows, 1)]
+        )
+        cursor.executemany(
+            "INSERT INTO episodes (anime_id, number, video_url, file_id) VALUES (%s, %s, %s, %s)",
+            episode_rows
+        )
+        cursor.execute("INSERT INTO users (user_id, is_admin) VALUES (%s, TRUE)", (ADMIN_ID,))
+
+def _seed_admins(conn, admin_ids):
+    with conn.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO users (user_id, is_admin) VALUES (%s, TRUE)",
+            [(admin_id,) for admin_id in admin_ids]
+        )
+
+async def seed_catalog(bot, episodes):
+    anime_rows, episode_rows = _seed_rows(episodes)
+    await bot.db.run(_seed, anime_rows, episode_rows)
+    counts = defaultdict(int)
+    for anime_id, _, _, _ in episode_rows:
+        counts[anime_id] += 1
+    return {anime_id: counts[anime_id] for anime_id in range(1, len(anime_rows) + 1)}
+
+# ===================== Поток обновлений =====================
+class UpdateFactory:
+    def __init__(self, catalog, users, rng):
+        self.catalog = catalog
+        self.anime_ids = list(catalog)
+        self.users = users
+        self.rng = rng
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_episodes = defaultdict(lambda: EPISODES_PER_TITLE)
+        # У каждого админского сценария свой администратор: нажатия одного
+        # пользователя ограничивает CallbackThrottle, а сценарии идут параллельно
+        self.admin_ids = itertools.count(ADMIN_ID + users + 1)
+        self.admins = []
+        # update_id -> update_id нажатия, без которого обновление ничего не делает
+        self.requires = {}
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def message(self, user_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, user_id, data):
+        update_id = next(self.update_ids)
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': 0,
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': '🎌 Выберите аниме из списка:',
+                },
+            },
+        }
+
+    def _admin(self):
+        admin_id = next(self.admin_ids)
+        self.admins.append(admin_id)
+        return admin_id
+
+    def _random_anime(self):
+        anime_id = self.rng.choice(self.anime_ids)
+        return anime_id, self.catalog[anime_id]
+
+    def scenario(self, name):
+        """Возвращает список (имя обработчика, update) для одного сценария."""
+        user_id = self.rng.randint(ADMIN_ID + 1, ADMIN_ID + self.users)
+        if name == 'menu':
+            return [('menu', self.message(user_id, '/menu'))]
+        if name == 'menu_page':
+            anime_id, _ = self._random_anime()
+            return [('menu_page', self.callback(user_id, f"menu_next_{anime_id}"))]
+        if name == 'anime_details':
+            anime_id, _ = self._random_anime()
+            return [('anime_details', self.callback(user_id, f"anime_{anime_id}"))]
+        if name == 'episodes_page':
+            anime_id, count = self._random_anime()
+            cursor = self.rng.randint(0, max(count - 1, 0))
+            return [('episodes_page', self.callback(user_id, f"eps_{anime_id}_next_{cursor}"))]
+        if name == 'watch_episode':
+            anime_id, count = self._random_anime()
+            number = self.rng.randint(1, max(count, 1))
+            return [('watch_episode', self.callback(user_id, f"episode_{anime_id}_{number}"))]
+        if name == 'receive_episode_data':
+            anime_id, _ = self._random_anime()
+            self.new_episodes[anime_id] += 1
+            number = self.new_episodes[anime_id]
+            admin_id = self._admin()
+            select = self.callback(admin_id, f"admin_episode_{anime_id}")
+            receive = self.message(admin_id, f"{number} | https://vk.com/video-2_{number}")
+            self.requires[receive['update_id']] = select['update_id']
+            return [('select_anime_for_episode', select), ('receive_episode_data', receive)]
+        if name == 'search':
+            anime_id, _ = self._random_anime()
+            return [('search_command', self.message(user_id, f"/search аниме {anime_id}"))]
+        if name == 'admin_stats':
+            return [('admin_stats', self.callback(self._admin(), 'admin_stats'))]
+        raise ValueError(name)
+
+    def stream(self, count):
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+        updates = []
+        while len(updates) < count:
+            updates.extend(self.scenario(self.rng.choices(names, weights)[0]))
+        return updates[:count]
+
+# ===================== Прогон =====================
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def summarize(latencies):
+    return {
+        'n': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+async def run_once(bot, args, episodes, stub):
+    from telegram import Update
+
+    catalog = await seed_catalog(bot, episodes)
+    bot.catalog_cache.clear()
+    bot.catalog_cache.hits = bot.catalog_cache.misses = 0
+    bot.render_cache.clear()
+    bot.render_cache.hits = bot.render_cache.misses = 0
+    bot.active_users_cache.clear()
+    bot.callback_throttle._buckets.clear()
+    dropped_before = {reason: bot.CALLBACKS_DROPPED.get(reason) for reason in ('duplicate', 'rate')}
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory(catalog, args.users, rng)
+    stream = factory.stream(args.updates)
+    await bot.db.run(_seed_admins, factory.admins)
+    for admin_id in factory.admins:
+        bot.admin_cache.add(admin_id)
+
+    application = bot.build_application()
+    await application.initialize()
+    bot.cover_sender.start(application.bot)
+    updates = [(name, Update.de_json(data, application.bot)) for name, data in stream]
+
+    db_calls = 0
+    original_run = bot.db.run
+
+    async def counting_run(func, *run_args, **run_kwargs):
+        nonlocal db_calls
+        db_calls += 1
+        return await original_run(func, *run_args, **run_kwargs)
+
+    bot.db.run = counting_run
+    errors = ErrorCounter()
+    logging.getLogger(bot.__name__).addHandler(errors)
+    stub.calls.clear()
+
+    latencies = defaultdict(list)
+    executed = set()
+
+    async def timed(name, update):
+        executed.add(update.update_id)
+        started = perf_counter()
+        await application.process_update(update)
+        latencies[name].append(perf_counter() - started)
+
+    started = perf_counter()
+    processor = application.update_processor
+    await asyncio.gather(*(
+        processor.process_update(update, timed(name, update)) for name, update in updates
+    ))
+    elapsed = perf_counter() - started
+    # Фоновые отправки обложек тоже обращаются к Bot API и БД — дожидаемся их
+    await bot.cover_sender.drain()
+    await bot.cover_sender.stop()
+    # Отложенная запись активности входит в число запросов, но не в задержку обработчиков
+    await bot.activity_tracker.flush()
+    await bot.watch_history.flush()
+
+    logging.getLogger(bot.__name__).removeHandler(errors)
+    del bot.db.run
+    await application.shutdown()
+
+    total = [value for values in latencies.values() for value in values]
+    present = {update.update_id for _, update in updates}
+    broken = sum(
+        1 for update_id, required in factory.requires.items()
+        if update_id in present and required not in executed
+    )
+    return {
+        'episodes': episodes,
+        'anime': len(catalog),
+        'updates': len(updates),
+        'concurrency': args.concurrency,
+        'elapsed_s': elapsed,
+        'updates_per_s': len(updates) / elapsed if elapsed else 0.0,
+        'db_calls_per_update': db_calls / len(updates),
+        'bot_api_calls': dict(stub.calls),
+        'errors': errors.count,
+        'cache_hit_ratio': bot.catalog_cache.hit_ratio,
+        'render_hit_ratio': bot.render_cache.hit_ratio,
+        'broken_scenarios': broken,
+        'callbacks_dropped': {
+            reason: bot.CALLBACKS_DROPPED.get(reason) - before for reason, before in dropped_before.items()
+        },
+        'total': summarize(total),
+        'handlers': {name: summarize(values) for name, values in sorted(latencies.items())},
+    }
+
+def print_result(result):
+    print(
+        f"\nКаталог: {result['episodes']} серий ({result['anime']} аниме), "
+        f"{result['updates']} обновлений, параллельность {result['concurrency']}"
+    )
+    print(f"{'обработчик':<26}{'n':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    rows = list(result['handlers'].items()) + [('итого', result['total'])]
+    for name, stats in rows:
+        print(
+            f"{name:<26}{stats['n']:>7}{stats['p50_ms']:>10.2f}"
+            f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        )
+    print(
+        f"обновлений/с: {result['updates_per_s']:.1f}  "
+        f"запросов к БД на обновление: {result['db_calls_per_update']:.2f}  "
+        f"попаданий в кэш: {result['cache_hit_ratio']:.0%}  "
+        f"готовых экранов: {result['render_hit_ratio']:.0%}  "
+        f"ошибок: {result['errors']}"
+    )
+    dropped = result['callbacks_dropped']
+    print(f"отброшено нажатий: повторных {dropped['duplicate']}, сверх лимита {dropped['rate']}")
+    if result['broken_scenarios']:
+        print(
+            f"⚠️ сценариев без подготовительного нажатия: {result['broken_scenarios']} — "
+            f"их обработчики ничего не делали, задержки и запросы к БД занижены"
+        )
+
+async def run(args, stub):
+    import bot
+
+    if args.database_url:
+        bot.db.start()
+        await bot.init_db()
+    else:
+        from sqlite_db import SQLiteDatabase
+        bot.db = SQLiteDatabase()
+        bot.db.start()
+
+    results = []
+    try:
+        for episodes in (int(size) for size in args.episodes.split(',')):
+            result = await run_once(bot, args, episodes, stub)
+            print_result(result)
+            results.append(result)
+    finally:
+        bot.db.close()
+    return results
+
+def main():
+    args = parse_args()
+    stub = StubBotAPI(delay=args.api_delay)
+    stub.start()
+    prepare_environment(args, stub.url)
+    # Логи обработчиков отключаем, чтобы не мерить вывод в консоль
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    try:
+        results = asyncio.run(run(args, stub))
+    finally:
+        stub.stop()
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if any(result['broken_scenarios'] for result in results):
+        sys.exit("Часть сценариев прогнана без подготовительного нажатия — результаты недостоверны")
+
+if __name__ == '__main__':
+    main()
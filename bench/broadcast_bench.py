@@ -0,0 +1,87 @@
+"""Офлайн-проверка рассылки уведомлений о новых сериях.
+
+Подписывает N пользователей на аниме, ставит уведомления в очередь и
+прогоняет Broadcaster из bot.py против заглушки Bot API, которая
+периодически отвечает 429 Too Many Requests. Печатает пропускную
+способность, число повторов и остаток очереди.
+
+    python bench/broadcast_bench.py --subscribers 500 --rate 25 --flood-every 200
+"""
+import os
+import sys
+import asyncio
+import argparse
+import logging
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_api import StubBotAPI
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--episodes', type=int, default=1, help='новых серий подряд (несколько сообщений в чат)')
+    parser.add_argument('--rate', type=float, default=25, help='BROADCAST_RATE, сообщений/с')
+    parser.add_argument('--flood-every', type=int, default=200, help='каждый N-й sendMessage получает 429')
+    parser.add_argument('--api-delay', type=float, default=0.0)
+    return parser.parse_args()
+
+def _seed(conn, subscribers):
+    with conn.cursor() as cursor:
+        cursor.execute("INSERT INTO anime (id, title, description) VALUES (1, 'Аниме', 'Описание')")
+        cursor.executemany(
+            "INSERT INTO subscriptions (user_id, anime_id) VALUES (%s, 1)",
+            [(user_id,) for user_id in range(1000, 1000 + subscribers)]
+        )
+
+async def run(args, stub):
+    from telegram import Bot
+    from sqlite_db import SQLiteDatabase
+    import bot
+
+    bot.db = SQLiteDatabase()
+    bot.db.start()
+    await bot.db.run(_seed, args.subscribers)
+
+    broadcaster = bot.Broadcaster(
+        args.rate, bot.BROADCAST_CHAT_INTERVAL, bot.BROADCAST_BATCH_SIZE,
+        bot.BROADCAST_CONCURRENCY, bot.BROADCAST_MAX_ATTEMPTS, bot.BROADCAST_POLL_INTERVAL,
+        bot.BROADCAST_LEASE
+    )
+    bot.broadcaster = broadcaster
+    queued = 0
+    for number in range(1, args.episodes + 1):
+        queued += await bot.enqueue_episode_notifications(1, number)
+
+    async with Bot('1:bench', base_url=f"{stub.url}/bot") as telegram_bot:
+        broadcaster._bot = telegram_bot
+        started = perf_counter()
+        while await broadcaster.process_batch():
+            pass
+        elapsed = perf_counter() - started
+
+    left = (await bot.db.fetchone("SELECT COUNT(*) FROM notification_queue"))[0]
+    bot.db.close()
+    print(f"в очереди: {queued}, отправлено: {broadcaster.sent}, ошибок: {broadcaster.failed}, "
+          f"повторов после 429: {broadcaster.retries}, осталось: {left}")
+    print(f"время: {elapsed:.1f} с, пропускная способность: {broadcaster.sent / elapsed:.1f} сообщ./с "
+          f"(лимит {args.rate:g}), вызовов sendMessage: {stub.calls['sendMessage']}")
+
+def main():
+    args = parse_args()
+    stub = StubBotAPI(delay=args.api_delay, flood_every=args.flood_every)
+    stub.start()
+    os.environ['BOT_TOKEN'] = '1:bench'
+    os.environ['DATABASE_URL'] = 'sqlite://memory'
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    try:
+        asyncio.run(run(args, stub))
+    finally:
+        stub.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Хранилище в памяти (SQLite) вместо PostgreSQL для бенчмарков.
+
+SQLiteDatabase подменяет пул psycopg2 одним соединением SQLite с интерфейсом,
+похожим на psycopg2, поэтому запросы из bot.py выполняются без изменений
+(плейсхолдеры %s переводятся в ?, а FOR UPDATE SKIP LOCKED отбрасывается —
+соединение одно, блокировать строки не от кого). Схема повторяет результат всех миграций
+из bot.MIGRATIONS и отмечена в schema_version как актуальная.
+"""
+import sqlite3
+import threading
+
+import bot
+
+SCHEMA = '''
+    CREATE TABLE anime (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        description TEXT,
+        cover_url TEXT,
+        cover_file_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX anime_title_id_idx ON anime (title, id);
+    CREATE TABLE episodes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+        number INTEGER NOT NULL,
+        video_url TEXT NOT NULL,
+        file_id TEXT,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE UNIQUE INDEX episodes_anime_number_idx ON episodes (anime_id, number);
+    CREATE TABLE users (
+        user_id BIGINT PRIMARY KEY,
+        is_admin BOOLEAN DEFAULT FALSE,
+        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX users_last_active_idx ON users (last_active);
+    CREATE TABLE subscriptions (
+        user_id BIGINT NOT NULL,
+        anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+        PRIMARY KEY (anime_id, user_id)
+    );
+    CREATE TABLE user_state (
+        user_id BIGINT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE watch_history (
+        user_id BIGINT NOT NULL,
+        anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+        number INTEGER NOT NULL,
+        watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, anime_id)
+    );
+    CREATE TABLE notification_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id BIGINT NOT NULL,
+        anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+        number INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        claimed_until TIMESTAMP
+    );
+    CREATE TABLE schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE stats_counters (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    );
+    INSERT INTO stats_counters (name) VALUES ('anime'), ('episodes'), ('users'), ('admins');
+    CREATE TRIGGER anime_stats_ins AFTER INSERT ON anime
+        BEGIN UPDATE stats_counters SET value = value + 1 WHERE name = 'anime'; END;
+    CREATE TRIGGER anime_stats_del AFTER DELETE ON anime
+        BEGIN UPDATE stats_counters SET value = value - 1 WHERE name = 'anime'; END;
+    CREATE TRIGGER episodes_stats_ins AFTER INSERT ON episodes
+        BEGIN UPDATE stats_counters SET value = value + 1 WHERE name = 'episodes'; END;
+    CREATE TRIGGER episodes_stats_del AFTER DELETE ON episodes
+        BEGIN UPDATE stats_counters SET value = value - 1 WHERE name = 'episodes'; END;
+    CREATE TRIGGER users_stats_ins AFTER INSERT ON users
+        BEGIN UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+              UPDATE stats_counters SET value = value + NEW.is_admin WHERE name = 'admins'; END;
+    CREATE TRIGGER users_stats_del AFTER DELETE ON users
+        BEGIN UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+              UPDATE stats_counters SET value = value - OLD.is_admin WHERE name = 'admins'; END;
+    CREATE TRIGGER users_stats_upd AFTER UPDATE OF is_admin ON users
+        BEGIN UPDATE stats_counters SET value = value + NEW.is_admin - OLD.is_admin WHERE name = 'admins'; END;
+'''
+
+def _translate(sql):
+    return sql.replace('%s', '?').replace(' FOR UPDATE SKIP LOCKED', '')
+
+class _Cursor:
+    def __init__(self, conn):
+        self._cursor = conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, sql, params=None):
+        self._cursor.execute(_translate(sql), params or ())
+
+    def executemany(self, sql, seq):
+        self._cursor.executemany(_translate(sql), seq)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+class _Connection:
+    """Обёртка над sqlite3 с транзакционным контекстом как у psycopg2."""
+
+    closed = 0
+
+    def __init__(self):
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.executemany(
+            "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+            [(version, description) for version, description, _ in bot.MIGRATIONS]
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+
+    def cursor(self):
+        return _Cursor(self._conn)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+class _SingleConnectionPool:
+    def __init__(self):
+        self._conn = _Connection()
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        self._lock.acquire()
+        return self._conn
+
+    def putconn(self, conn, close=False):
+        self._lock.release()
+
+    def closeall(self):
+        self._conn.close()
+
+class SQLiteDatabase(bot.Database):
+    def __init__(self):
+        super().__init__(':memory:', 1, 1, bot.DB_HEALTHCHECK_INTERVAL)
+
+    def start(self):
+        if self._pool is not None:
+            return
+        self._pool = _SingleConnectionPool()
+        self._executor = bot.ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
@@ -0,0 +1,115 @@
+"""Заглушка Telegram Bot API для офлайн-бенчмарков.
+
+Отвечает на вызовы бота минимально корректными объектами, считает вызовы
+по методам и может имитировать сетевую задержку Telegram.
+"""
+import json
+import itertools
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'StubBot', 'username': 'stub_bot'}
+
+class StubBotAPI:
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, flood_every=0, retry_after=1):
+        self.delay = delay
+        # Каждый flood_every-й sendMessage получает 429 Too Many Requests
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _message(self, params, **extra):
+        chat_id = params.get('chat_id') or 1
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(extra)
+        return message
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendPhoto':
+            n = next(self._message_ids)
+            photo = {'file_id': f'photo-{n}', 'file_unique_id': f'p{n}', 'width': 320, 'height': 480}
+            return self._message(params, photo=[photo])
+        if method == 'sendVideo':
+            n = next(self._message_ids)
+            video = {
+                'file_id': f'video-{n}', 'file_unique_id': f'v{n}',
+                'width': 1280, 'height': 720, 'duration': 1440,
+            }
+            return self._message(params, video=video)
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            return self._message(params, text=params.get('text', ''))
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело пишутся отдельно: без TCP_NODELAY каждый ответ ждёт ~40 мс
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    # multipart/form-data (загрузка файлов) — параметры не нужны
+                    params = {}
+                with api._lock:
+                    api.calls[method] += 1
+                    flood = (
+                        api.flood_every and method == 'sendMessage'
+                        and api.calls[method] % api.flood_every == 0
+                    )
+                if api.delay:
+                    time.sleep(api.delay)
+                if flood:
+                    status = 429
+                    payload = json.dumps({
+                        'ok': False,
+                        'error_code': 429,
+                        'description': f'Too Many Requests: retry after {api.retry_after}',
+                        'parameters': {'retry_after': api.retry_after},
+                    }).encode()
+                else:
+                    status = 200
+                    payload = json.dumps({'ok': True, 'result': api._result(method, params)}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
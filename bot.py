@@ -1,218 +1,2602 @@
 import os
 import sys
+import csv
+import gzip
+import html
+import json
+import time
+import asyncio
+import heapq
+import bisect
+import queue
+import atexit
 import logging
+import logging.handlers
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import psycopg2
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import psycopg2.pool
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent
+)
 from telegram.ext import (
     Application,
     CommandHandler,
+    BasePersistence,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
+    TypeHandler,
     filters
 )
+from telegram.error import Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+
+# Загружаем переменные окружения из .env
+load_dotenv()
+
+# Загрузка переменных окружения
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько обновлений обрабатывается одновременно (1 — строго последовательно)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))
+# Адрес Bot API без суффикса /bot, например локальный сервер для тестов
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# Хранилище user_data (состояние админских диалогов): postgres, pickle или none
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'postgres')
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_state.pickle')
+# Как часто (сек) изменённые данные пачкой сохраняются в хранилище
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+# Несколько экземпляров бота: перечитывать состояние админов перед каждым обновлением
+PERSISTENCE_SHARED = os.getenv('PERSISTENCE_SHARED', 'false').lower() in ('1', 'true', 'yes')
+
+# Логи: уровень, формат (json — одна строка JSON на запись, text — обычный текст)
+# и прореживание шумных категорий уровня INFO: "<категория или логгер>=<доля>,..."
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'httpx=0.01')
+# Обработчик дольше этого времени (мс) пишет предупреждение с latency_ms
+LOG_SLOW_HANDLER_MS = float(os.getenv('LOG_SLOW_HANDLER_MS', '1000'))
+
+# Проверка переменных
+if not BOT_TOKEN:
+    print("ERROR: BOT_TOKEN not set!")
+    sys.exit(1)
+
+if not DATABASE_URL:
+    print("ERROR: DATABASE_URL not set!")
+    sys.exit(1)
+
+if BOT_MODE not in ('polling', 'webhook'):
+    print(f"ERROR: unknown BOT_MODE: {BOT_MODE}")
+    sys.exit(1)
+
+if PERSISTENCE_BACKEND not in ('postgres', 'pickle', 'none'):
+    print(f"ERROR: unknown PERSISTENCE_BACKEND: {PERSISTENCE_BACKEND}")
+    sys.exit(1)
+
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    print("ERROR: WEBHOOK_URL not set!")
+    sys.exit(1)
+
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    print("ERROR: WEBHOOK_SECRET not set!")
+    sys.exit(1)
+
+if LOG_FORMAT not in ('json', 'text'):
+    print(f"ERROR: unknown LOG_FORMAT: {LOG_FORMAT}")
+    sys.exit(1)
+
+# ===================== Логгирование =====================
+# Поля контекста текущего обновления, которые попадают в каждую запись лога
+_log_context = contextvars.ContextVar('log_context', default=None)
+LOG_FIELDS = ('handler', 'user_id', 'update_id', 'latency_ms', 'category')
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def parse_log_sampling(value):
+    """"httpx=0.01,catalog=0.1" -> {'httpx': 100, 'catalog': 10}: сохранять каждую N-ю запись."""
+    every = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        category, _, rate = item.partition('=')
+        rate = float(rate)
+        every[category.strip()] = round(1 / rate) if rate > 0 else 0
+    return every
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи поля контекста (обработчик, пользователь, обновление)."""
+
+    def filter(self, record):
+        context = _log_context.get()
+        if context:
+            for key, value in context.items():
+                record.__dict__.setdefault(key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись уровня INFO и ниже для шумных категорий.
+
+    Категория — поле category записи или имя логгера (с учётом родителей:
+    правило для httpx действует и на httpx._client). Предупреждения и ошибки
+    не прореживаются.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._rules = {}
+        self._counters = {}
+
+    def _rule(self, category):
+        if category not in self._rules:
+            rule = None
+            name = category
+            while name:
+                if name in self.every:
+                    rule = name
+                    break
+                name = name.rpartition('.')[0]
+            self._rules[category] = rule
+        return self._rules[category]
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not self.every:
+            return True
+        rule = self._rule(getattr(record, 'category', None) or record.name)
+        if rule is None:
+            return True
+        every = self.every[rule]
+        if not every:
+            return False
+        count = self._counters.get(rule, 0)
+        self._counters[rule] = count + 1
+        return count % every == 0
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler с отложенным форматированием записи.
+
+    Стандартный prepare() сразу форматирует всю запись вместе с трассировкой.
+    Здесь в потоке вызова подставляются только аргументы сообщения: это
+    дёшево, а изменяемые объекты (user_data, списки) могут поменяться, пока
+    запись ждёт в очереди. JSON, трассировку и вывод делает поток
+    QueueListener.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_log_sampling(LOG_SAMPLING)))
+    queue_handler.addFilter(LogContextFilter())
+    # Если логгирование уже настроено (например, бенчмарком), basicConfig ничего не меняет
+    logging.basicConfig(handlers=[queue_handler], level=LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# ===================== Метрики =====================
+# Порт локального эндпоинта /metrics в формате Prometheus (0 — выключен)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(label, value):
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{{{label}="{escaped}"}}'
+
+class Counter:
+    """Счётчик с одной меткой. Обновляется только из цикла событий."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value, amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def get(self, label_value):
+        return self._values.get(label_value, 0)
+
+    def samples(self):
+        for label_value, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label, label_value)} {value}"
+
+class Histogram:
+    """Гистограмма длительностей (сек) с одной меткой."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        # метка -> [счётчики по корзинам (+Inf последней), сумма, количество]
+        self._series = {}
+
+    def observe(self, label_value, seconds):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def count(self, label_value):
+        series = self._series.get(label_value)
+        return series[2] if series else 0
+
+    def samples(self):
+        for label_value, (counts, total, count) in sorted(self._series.items()):
+            escaped = _format_labels(self.label, label_value)[1:-1]
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{{{escaped},le="{bound}"}} {cumulative}'
+            yield f"{self.name}_sum{{{escaped}}} {total:.6f}"
+            yield f"{self.name}_count{{{escaped}}} {count}"
+
+class Gauge:
+    """Значения, вычисляемые в момент запроса /metrics: collect() -> [(метка, значение)]."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label, collect):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._collect = collect
+
+    def samples(self):
+        for label_value, value in self._collect():
+            yield f"{self.name}{_format_labels(self.label, label_value)} {value}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logger.warning("Не удалось собрать метрику %s: %s", metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram(
+    'bot_handler_duration_seconds', 'Время обработки обновления обработчиком', 'handler'
+))
+# Обработчики сами перехватывают исключения и пишут их в лог, поэтому ошибки
+# считаются по записям уровня ERROR (метка — функция, записавшая ошибку)
+HANDLER_ERRORS = metrics.register(Counter(
+    'bot_errors_total', 'Ошибки по функциям-обработчикам', 'handler'
+))
+DB_QUERY_LATENCY = metrics.register(Histogram(
+    'bot_db_query_duration_seconds', 'Длительность запросов к БД, включая ожидание потока', 'query'
+))
+DB_QUERY_ERRORS = metrics.register(Counter(
+    'bot_db_query_errors_total', 'Запросы к БД, завершившиеся исключением', 'query'
+))
+API_LATENCY = metrics.register(Histogram(
+    'bot_api_request_duration_seconds', 'Длительность вызовов Telegram Bot API', 'method'
+))
+API_ERRORS = metrics.register(Counter(
+    'bot_api_request_errors_total', 'Вызовы Bot API с ответом не 200 или сетевой ошибкой', 'method'
+))
+metrics.register(Gauge(
+    'bot_cache_hit_ratio', 'Доля попаданий в кэши', 'cache',
+    lambda: [
+        ('catalog', catalog_cache.hit_ratio),
+        ('search', search_index.cache.hit_ratio),
+        ('admin', admin_cache.hit_ratio),
+        ('render', render_cache.hit_ratio),
+        ('watch_history', watch_history.hit_ratio),
+    ]
+))
+metrics.register(Gauge(
+    'bot_cache_requests', 'Обращения к кэшам с момента запуска', 'result',
+    lambda: [
+        ('catalog_hit', catalog_cache.hits),
+        ('catalog_miss', catalog_cache.misses),
+        ('search_hit', search_index.cache.hits),
+        ('search_miss', search_index.cache.misses),
+        ('admin_hit', admin_cache.hits),
+        ('admin_refresh', admin_cache.refreshes),
+        ('render_hit', render_cache.hits),
+        ('render_miss', render_cache.misses),
+        ('watch_history_hit', watch_history.hits),
+        ('watch_history_miss', watch_history.misses),
+    ]
+))
+metrics.register(Gauge(
+    'bot_background', 'Состояние фоновых задач', 'value',
+    lambda: [
+        ('activity_pending', len(activity_tracker)),
+        ('watch_history_pending', len(watch_history)),
+        ('db_circuit_open', int(db.breaker.is_open)),
+        ('broadcast_sent', broadcaster.sent),
+        ('broadcast_failed', broadcaster.failed),
+        ('broadcast_retries', broadcaster.retries),
+        ('cover_queue', len(cover_sender)),
+        ('cover_sent', cover_sender.sent),
+        ('cover_failed', cover_sender.failed),
+        ('cover_dropped', cover_sender.dropped),
+    ]
+))
+
+class ErrorCountingHandler(logging.Handler):
+    def emit(self, record):
+        HANDLER_ERRORS.inc(record.funcName)
+
+logger.addHandler(ErrorCountingHandler(logging.ERROR))
+
+def instrument_handler(callback):
+    """Оборачивает callback обработчика PTB замером длительности."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = getattr(update, 'effective_user', None)
+        token = _log_context.set({
+            'handler': name,
+            'user_id': user.id if user else None,
+            'update_id': getattr(update, 'update_id', None),
+        })
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(name, elapsed)
+            latency_ms = round(elapsed * 1000, 1)
+            if latency_ms >= LOG_SLOW_HANDLER_MS:
+                logger.warning("Медленная обработка обновления: %s мс", latency_ms,
+                               extra={'category': 'handler', 'latency_ms': latency_ms})
+            else:
+                logger.debug("Обновление обработано за %s мс", latency_ms,
+                             extra={'category': 'handler', 'latency_ms': latency_ms})
+            _log_context.reset(token)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий длительность каждого вызова Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(api_method)
+            raise
+        finally:
+            API_LATENCY.observe(api_method, time.perf_counter() - started)
+        if code != 200:
+            API_ERRORS.inc(api_method)
+        return code, payload
+
+class MetricsServer:
+    """Минимальный HTTP-сервер на asyncio, отдающий metrics.render() по /metrics."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Заголовки запроса не нужны, но их надо дочитать до пустой строки
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[1].split('?', 1)[0] == '/metrics':
+                status = '200 OK'
+                body = metrics.render().encode()
+            else:
+                status = '404 Not Found'
+                body = b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        if not self.port or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("📈 Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+# ===================== Пул соединений с PostgreSQL =====================
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Соединение, простаивавшее дольше этого времени (сек), проверяется через SELECT 1
+DB_HEALTHCHECK_INTERVAL = float(os.getenv('DB_HEALTHCHECK_INTERVAL', '30'))
+# Для локального PostgreSQL без TLS (например, в бенчмарках) — disable
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+# Таймауты (сек) подключения и одного запроса: медленная БД считается недоступной
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+DB_QUERY_TIMEOUT = float(os.getenv('DB_QUERY_TIMEOUT', '10'))
+# После стольких сбоев подряд запросы к БД отклоняются сразу, пробный — через DB_BREAKER_RESET сек
+DB_BREAKER_THRESHOLD = int(os.getenv('DB_BREAKER_THRESHOLD', '3'))
+DB_BREAKER_RESET = float(os.getenv('DB_BREAKER_RESET', '5'))
+
+class DatabaseUnavailable(Exception):
+    """БД недоступна: автомат разомкнут, запрос даже не отправлялся."""
+
+# Ошибки, после которых чтение каталога переключается на снимок
+DB_UNAVAILABLE_ERRORS = (
+    DatabaseUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.TimeoutError
+)
+
+class CircuitBreaker:
+    """Автоматический выключатель для запросов к БД.
+
+    После threshold ошибок соединения подряд размыкается: запросы сразу
+    получают DatabaseUnavailable, не дожидаясь таймаутов. Через reset_timeout
+    пропускает один пробный запрос; его успех снова замыкает автомат.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        self._probing = True
+        return True
+
+    def record(self, ok):
+        self._probing = False
+        if ok:
+            if self._opened_at is not None:
+                logger.info("🔌 Соединение с БД восстановлено")
+            self.failures = 0
+            self._opened_at = None
+            return
+        self.failures += 1
+        if self._opened_at is None and self.failures >= self.threshold:
+            logger.warning("🔌 БД недоступна: каталог читается из снимка")
+        if self._opened_at is not None or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
+    def abandon(self):
+        """Запрос отменён вызывающим кодом: результат неизвестен, сбоем не считаем."""
+        self._probing = False
+
+    def trip(self):
+        """Размыкает автомат сразу, например если БД недоступна при запуске."""
+        self.failures = max(self.failures, self.threshold - 1)
+        self.record(False)
+
+class Database:
+    """Пул соединений psycopg2 и ограниченный пул потоков для запросов.
+
+    Блокирующие вызовы psycopg2 выполняются в отдельных потоках, поэтому
+    медленный запрос не останавливает цикл событий бота. Количество потоков
+    равно максимальному размеру пула: поток никогда не ждёт соединение.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, healthcheck_interval, sslmode='require',
+                 connect_timeout=None, query_timeout=None, breaker=None):
+        self.dsn = dsn
+        self.sslmode = sslmode
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.healthcheck_interval = healthcheck_interval
+        self.connect_timeout = connect_timeout
+        self.query_timeout = query_timeout
+        self.breaker = breaker or CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._executor = None
+        self._last_used = {}
+
+    def start(self):
+        """Запускает пул потоков и подключается к БД.
+
+        Если БД недоступна, исключение пробрасывается, а пул будет создан
+        при первом запросе после восстановления.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.maxconn, thread_name_prefix='db'
+            )
+        self._ensure_pool()
+
+    def _ensure_pool(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                return
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                self.minconn, self.maxconn, self.dsn, sslmode=self.sslmode,
+                connect_timeout=self.connect_timeout
+            )
+        logger.info("🔌 Пул соединений запущен (%s-%s)", self.minconn, self.maxconn)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+            self._last_used.clear()
+        logger.info("🔌 Пул соединений закрыт")
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _getconn(self):
+        # Одна повторная попытка: мёртвое соединение выбрасывается из пула
+        for _ in range(2):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            logger.warning("♻️ Соединение с БД неисправно, переподключаемся")
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+    @contextmanager
+    def connection(self):
+        """Берёт соединение из пула; коммит при успехе, откат при ошибке."""
+        if self._executor is None:
+            raise RuntimeError("Пул соединений не запущен")
+        self._ensure_pool()
+        conn = self._getconn()
+        broken = False
+        try:
+            with conn:
+                yield conn
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            broken = broken or bool(conn.closed)
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
+
+    def _run_sync(self, func, *args):
+        with self.connection() as conn:
+            return func(conn, *args)
+
+    async def run(self, func, *args, name=None, timeout=None):
+        """Выполняет func(conn, *args) в пуле потоков внутри одной транзакции.
+
+        name — имя запроса в метриках (по умолчанию имя func), timeout —
+        ожидание результата в секундах (по умолчанию query_timeout, 0 — без
+        ограничения). При разомкнутом автомате сразу бросает DatabaseUnavailable.
+        """
+        if self._executor is None:
+            raise RuntimeError("Пул соединений не запущен")
+        name = name or func.__name__
+        if not self.breaker.allow():
+            DB_QUERY_ERRORS.inc(name)
+            raise DatabaseUnavailable("БД недоступна")
+        timeout = self.query_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._run_sync, func, *args)
+        started = time.perf_counter()
+        try:
+            result = await (asyncio.wait_for(future, timeout) if timeout else future)
+        except asyncio.CancelledError:
+            # Отмена снаружи (внешний wait_for, остановка бота) ничего не говорит о БД
+            self.breaker.abandon()
+            raise
+        except DB_UNAVAILABLE_ERRORS:
+            DB_QUERY_ERRORS.inc(name)
+            self.breaker.record(False)
+            raise
+        except Exception:
+            # Ошибка самого запроса: БД ответила, автомат не размыкаем
+            DB_QUERY_ERRORS.inc(name)
+            self.breaker.record(True)
+            raise
+        else:
+            self.breaker.record(True)
+            return result
+        finally:
+            DB_QUERY_LATENCY.observe(name, time.perf_counter() - started)
+
+    @staticmethod
+    def _caller_name():
+        # Имя функции, вызвавшей execute/fetchone/fetchall, без .<locals>.<lambda>
+        code = sys._getframe(2).f_code
+        return getattr(code, 'co_qualname', code.co_name).split('.<locals>', 1)[0]
+
+    async def execute(self, sql, params=None):
+        def _execute(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.rowcount
+        return await self.run(_execute, name=self._caller_name())
+
+    async def fetchone(self, sql, params=None):
+        def _fetchone(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchone()
+        return await self.run(_fetchone, name=self._caller_name())
+
+    async def fetchall(self, sql, params=None):
+        def _fetchall(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+        return await self.run(_fetchall, name=self._caller_name())
+
+db = Database(
+    DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_HEALTHCHECK_INTERVAL, DB_SSLMODE,
+    connect_timeout=DB_CONNECT_TIMEOUT, query_timeout=DB_QUERY_TIMEOUT
+)
+
+# ===================== Кэш каталога =====================
+CACHE_TTL = float(os.getenv('CACHE_TTL', '300'))
+CACHE_MAXSIZE = int(os.getenv('CACHE_MAXSIZE', '1024'))
+
+_MISSING = object()
+# Количество кнопок на одной странице списков аниме и серий
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '10'))
+
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей.
+
+    Используется только из цикла событий, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def invalidate_prefix(self, *prefix):
+        """Удаляет все ключи-кортежи, начинающиеся с prefix."""
+        n = len(prefix)
+        for key in [k for k in self._data if k[:n] == prefix]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_load(self, key, loader):
+        """Читает значение из кэша, при промахе вызывает loader(). None не кэшируется."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = await loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+catalog_cache = TTLCache(CACHE_MAXSIZE, CACHE_TTL)
+
+# ===================== Кэш отрисовки экранов =====================
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '1024'))
+
+class RenderCache(TTLCache):
+    """Готовые тексты и клавиатуры экранов каталога, общие для всех пользователей.
+
+    Ключи включают версию каталога: bump() после правок делает старые
+    записи недостижимыми, и они вытесняются как обычные LRU-записи.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.version = 0
+
+    def bump(self):
+        self.version += 1
+
+    async def get_or_render(self, key, render):
+        # Версия фиксируется до отрисовки: правка во время await не закэширует старый экран
+        return await self.get_or_load((self.version, *key), render)
+
+render_cache = RenderCache(RENDER_CACHE_SIZE, CACHE_TTL)
+
+# ===================== Кэш прав администратора =====================
+# Максимальная «устарелость» списка админов (сек), если права меняли вне этого процесса
+ADMIN_CACHE_TTL = float(os.getenv('ADMIN_CACHE_TTL', '60'))
+
+class AdminCache:
+    """Множество id администраторов в памяти с периодической перезагрузкой из БД."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.refreshes = 0
+        self._ids = frozenset()
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def refresh(self):
+        rows = await db.fetchall("SELECT user_id FROM users WHERE is_admin = TRUE")
+        self._ids = frozenset(user_id for user_id, in rows)
+        self._loaded_at = time.monotonic()
+        self.refreshes += 1
+
+    async def contains(self, user_id):
+        if self._is_stale():
+            async with self._lock:
+                # Пока ждали блокировку, список мог обновить другой обработчик
+                if self._is_stale():
+                    await self.refresh()
+        else:
+            self.hits += 1
+        return user_id in self._ids
+
+    def add(self, user_id):
+        self._ids = self._ids | {user_id}
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.refreshes
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._ids)
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+
+# ===================== Поиск по каталогу =====================
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '10'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '2048'))
+# Минимальная оценка совпадения, ниже которой результат не показывается
+SEARCH_MIN_SCORE = 0.3
+
+def _normalize_words(text):
+    text = (text or '').lower().replace('ё', 'е')
+    return ''.join(ch if ch.isalnum() else ' ' for ch in text).split()
+
+def _trigrams(words):
+    """Триграммы слов с отступами по краям, как в pg_trgm."""
+    grams = set()
+    for word in words:
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class SearchIndex:
+    """Триграммный индекс названий и описаний аниме в памяти.
+
+    Загружается из БД один раз (лениво) и дополняется в add_anime, поэтому
+    поиск не обращается к PostgreSQL. Ответы кэшируются по тексту запроса.
+    """
+
+    def __init__(self, cache_size, ttl):
+        self.cache = TTLCache(cache_size, ttl)
+        self._docs = {}
+        self._title_grams = {}
+        self._title_index = {}
+        self._description_index = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def _add(self, anime_id, title, description, cover_url):
+        title_words = _normalize_words(title)
+        self._docs[anime_id] = (title, description, cover_url, ' '.join(title_words))
+        grams = _trigrams(title_words)
+        self._title_grams[anime_id] = len(grams)
+        for gram in grams:
+            self._title_index.setdefault(gram, set()).add(anime_id)
+        for gram in _trigrams(_normalize_words(description)):
+            self._description_index.setdefault(gram, set()).add(anime_id)
+
+    async def load(self):
+        rows = await with_snapshot(
+            lambda: db.fetchall("SELECT id, title, description, cover_url FROM anime"),
+            catalog_snapshot.search_rows
+        )
+        self._docs.clear()
+        self._title_grams.clear()
+        self._title_index.clear()
+        self._description_index.clear()
+        for row in rows:
+            self._add(*row)
+        self.cache.clear()
+        self._loaded = True
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    await self.load()
+
+    def add(self, anime_id, title, description, cover_url):
+        # До первой загрузки новое аниме попадёт в индекс вместе с остальными
+        if self._loaded:
+            self._add(anime_id, title, description, cover_url)
+            self.cache.clear()
+
+    def _search(self, words, limit):
+        query_grams = _trigrams(words)
+        phrase = ' '.join(words)
+        title_shared = {}
+        description_shared = {}
+        for gram in query_grams:
+            for anime_id in self._title_index.get(gram, ()):
+                title_shared[anime_id] = title_shared.get(anime_id, 0) + 1
+            for anime_id in self._description_index.get(gram, ()):
+                description_shared[anime_id] = description_shared.get(anime_id, 0) + 1
+
+        scored = []
+        for anime_id in title_shared.keys() | description_shared.keys():
+            shared = title_shared.get(anime_id, 0)
+            # Сходство Жаккара по триграммам названия + бонус за вхождение подстроки
+            score = shared / (len(query_grams) + self._title_grams[anime_id] - shared)
+            if phrase in self._docs[anime_id][3]:
+                score += 0.5
+            score += 0.3 * description_shared.get(anime_id, 0) / len(query_grams)
+            if score >= SEARCH_MIN_SCORE:
+                scored.append((score, anime_id))
+        return [
+            (anime_id, *self._docs[anime_id][:3])
+            for score, anime_id in heapq.nlargest(limit, scored)
+        ]
+
+    async def search(self, text, limit=SEARCH_LIMIT):
+        """Возвращает до limit строк (id, title, description, cover_url)."""
+        words = _normalize_words(text)
+        if not words:
+            return []
+        await self._ensure_loaded()
+        key = (' '.join(words), limit)
+        results = self.cache.get(key, _MISSING)
+        if results is _MISSING:
+            results = self._search(words, limit)
+            self.cache.set(key, results)
+        return results
+
+search_index = SearchIndex(SEARCH_CACHE_SIZE, CACHE_TTL)
+
+# ===================== Учёт активности пользователей =====================
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '30'))
+ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', '500'))
+
+def _utc_from_timestamp(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
+
+def _placeholders(count):
+    return ', '.join(['%s'] * count)
+
+def _execute_values(cursor, sql, rows, template=None, batch_size=None):
+    """Выполняет sql с многострочным VALUES: {values} заменяется строками rows.
+
+    template — шаблон одной строки (по умолчанию «(%s, ...)» по числу полей),
+    batch_size — не больше стольких строк в одном запросе (по умолчанию все
+    строки одним запросом). Переносимо в SQLite, в отличие от execute_values.
+    """
+    batch_size = batch_size or len(rows)
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        row_sql = template or f"({_placeholders(len(batch[0]))})"
+        cursor.execute(
+            sql.replace('{values}', ", ".join([row_sql] * len(batch))),
+            [value for row in batch for value in row]
+        )
+
+def _upsert_activity(conn, rows, batch_size):
+    with conn.cursor() as cursor:
+        _execute_values(
+            cursor,
+            "INSERT INTO users (user_id, last_active) VALUES {values} "
+            "ON CONFLICT (user_id) DO UPDATE SET last_active = EXCLUDED.last_active",
+            rows, batch_size=batch_size
+        )
+
+class WriteBehindBuffer:
+    """Отложенная запись: изменения копятся в self._pending и раз в interval
+    сохраняются в БД пачками по batch_size строк.
+
+    Подкласс задаёт _write(pending) — запись снятой копии — и
+    _requeue(pending) — возврат записей после ошибки, если за время записи
+    не появилось более свежих. description — что сохраняется (для лога).
+    """
+
+    description = 'данных'
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._task = None
+
+    async def _write(self, pending):
+        raise NotImplementedError
+
+    def _requeue(self, pending):
+        for key, value in pending.items():
+            self._pending.setdefault(key, value)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._write(pending)
+        except Exception:
+            self._requeue(pending)
+            raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка при сохранении %s: %s", self.description, e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+class ActivityTracker(WriteBehindBuffer):
+    """Копит время последней активности в памяти и периодически сбрасывает в users.
+
+    На каждое обновление — только запись в словарь; в БД уходит один
+    многострочный INSERT ... ON CONFLICT на batch_size пользователей.
+    """
+
+    description = 'активности пользователей'
+
+    def __init__(self, interval, batch_size):
+        super().__init__(interval, batch_size)
+        self.flushed = 0
+
+    def touch(self, user_id):
+        self._pending[user_id] = time.time()
+
+    async def _write(self, pending):
+        rows = [(user_id, _utc_from_timestamp(ts)) for user_id, ts in pending.items()]
+        await db.run(_upsert_activity, rows, self.batch_size)
+        self.flushed += len(rows)
+
+activity_tracker = ActivityTracker(ACTIVITY_FLUSH_INTERVAL, ACTIVITY_BATCH_SIZE)
+
+# ===================== История просмотров =====================
+WATCH_FLUSH_INTERVAL = float(os.getenv('WATCH_FLUSH_INTERVAL', '30'))
+WATCH_CACHE_SIZE = int(os.getenv('WATCH_CACHE_SIZE', '10000'))
+WATCH_BATCH_SIZE = 500
+
+def _upsert_watch_history(conn, rows, batch_size):
+    with conn.cursor() as cursor:
+        _execute_values(
+            cursor,
+            "INSERT INTO watch_history (user_id, anime_id, number, watched_at) VALUES {values} "
+            "ON CONFLICT (user_id, anime_id) DO UPDATE "
+            "SET number = EXCLUDED.number, watched_at = EXCLUDED.watched_at",
+            rows, batch_size=batch_size
+        )
+
+class WatchHistory(WriteBehindBuffer):
+    """Последняя просмотренная серия каждого аниме для каждого пользователя.
+
+    Просмотры копятся в памяти и периодически сохраняются одним многострочным
+    INSERT ... ON CONFLICT. Последний просмотр пользователя читается из
+    LRU-кэша на cache_size пользователей (включая тех, кто ничего не смотрел),
+    поэтому /start и /menu обычно не обращаются к БД.
+    """
+
+    description = 'истории просмотров'
+
+    def __init__(self, interval, batch_size, cache_size):
+        super().__init__(interval, batch_size)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # _pending: user_id -> {anime_id: (номер серии, время просмотра)}
+        # user_id -> (anime_id, номер серии) или None
+        self._cache = OrderedDict()
+
+    def _remember(self, user_id, entry):
+        self._cache[user_id] = entry
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def record(self, user_id, anime_id, number):
+        self._pending.setdefault(user_id, {})[anime_id] = (number, time.time())
+        self._remember(user_id, (anime_id, number))
+
+    async def last(self, user_id):
+        """(anime_id, номер) последней просмотренной серии или None."""
+        entry = self._cache.get(user_id, _MISSING)
+        if entry is not _MISSING:
+            self.hits += 1
+            self._cache.move_to_end(user_id)
+            return entry
+        self.misses += 1
+        row = await db.fetchone(
+            "SELECT anime_id, number FROM watch_history WHERE user_id = %s "
+            "ORDER BY watched_at DESC LIMIT 1",
+            (user_id,)
+        )
+        # Пока ждали БД, мог прийти новый просмотр
+        entry = self._cache.get(user_id, _MISSING)
+        if entry is not _MISSING:
+            return entry
+        pending = self._pending.get(user_id)
+        if pending:
+            # Несохранённые просмотры новее записанных в БД
+            anime_id, (number, ts) = max(pending.items(), key=lambda item: item[1][1])
+            entry = (anime_id, number)
+        else:
+            entry = tuple(row) if row else None
+        self._remember(user_id, entry)
+        return entry
+
+    async def _write(self, pending):
+        rows = [
+            (user_id, anime_id, number, _utc_from_timestamp(ts))
+            for user_id, watched in pending.items()
+            for anime_id, (number, ts) in watched.items()
+        ]
+        await db.run(_upsert_watch_history, rows, self.batch_size)
+
+    def _requeue(self, pending):
+        for user_id, watched in pending.items():
+            current = self._pending.setdefault(user_id, {})
+            for anime_id, progress in watched.items():
+                current.setdefault(anime_id, progress)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return sum(len(watched) for watched in self._pending.values())
+
+watch_history = WatchHistory(WATCH_FLUSH_INTERVAL, WATCH_BATCH_SIZE, WATCH_CACHE_SIZE)
+
+# ===================== Снимок каталога =====================
+# Файл снимка (gzip + JSON); пустое значение отключает снимок
+SNAPSHOT_FILE = os.getenv('SNAPSHOT_FILE', 'catalog_snapshot.json.gz')
+# Полное обновление раз в SNAPSHOT_INTERVAL сек и через SNAPSHOT_DELAY сек после правок каталога
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '600'))
+SNAPSHOT_DELAY = float(os.getenv('SNAPSHOT_DELAY', '5'))
+
+SNAPSHOT_READS = metrics.register(Counter(
+    'bot_snapshot_reads_total', 'Чтения каталога из снимка при недоступной БД', 'query'
+))
+
+def _dump_catalog(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, title, description, cover_url, cover_file_id FROM anime")
+        anime = cursor.fetchall()
+        cursor.execute("SELECT anime_id, number, video_url, file_id FROM episodes")
+        episodes = cursor.fetchall()
+    return anime, episodes
+
+class CatalogSnapshot:
+    """Копия каталога на диске для работы без PostgreSQL (только чтение).
+
+    Фоновая задача перезаписывает файл после правок каталога (с задержкой,
+    чтобы объединить пакет правок) и периодически. В память снимок читается
+    только когда БД недоступна и освобождается после следующего обновления.
+    Методы чтения возвращают то же, что соответствующие запросы к БД.
+    """
+
+    def __init__(self, path, interval, delay):
+        self.path = path
+        self.interval = interval
+        self.delay = delay
+        self.saved_at = None
+        self._data = None
+        self._dirty = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _write(self, anime, episodes, saved_at):
+        payload = json.dumps(
+            {'saved_at': saved_at, 'anime': anime, 'episodes': episodes},
+            ensure_ascii=False, separators=(',', ':')
+        ).encode()
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as file:
+            file.write(payload)
+        # Атомарная замена: при сбое остаётся предыдущий снимок
+        os.replace(tmp_path, self.path)
+
+    def _read(self):
+        with gzip.open(self.path, 'rb') as file:
+            raw = json.loads(file.read())
+        anime = {row[0]: tuple(row) for row in raw['anime']}
+        episodes = {}
+        for anime_id, number, video_url, file_id in raw['episodes']:
+            episodes.setdefault(anime_id, {})[number] = (video_url, file_id)
+        return {
+            'saved_at': raw['saved_at'],
+            'anime': anime,
+            'order': sorted((title, anime_id) for anime_id, title, *_ in anime.values()),
+            'episodes': episodes,
+            'numbers': {anime_id: sorted(numbers) for anime_id, numbers in episodes.items()},
+        }
+
+    async def refresh(self):
+        if not self.path:
+            return
+        anime, episodes = await db.run(_dump_catalog)
+        saved_at = time.time()
+        await asyncio.to_thread(self._write, anime, episodes, saved_at)
+        self.saved_at = saved_at
+        self._data = None
+
+    async def ensure_loaded(self):
+        """Читает снимок с диска; False, если снимка нет."""
+        if self._data is None and self.path:
+            async with self._lock:
+                if self._data is None:
+                    try:
+                        self._data = await asyncio.to_thread(self._read)
+                    except FileNotFoundError:
+                        return False
+                    self.saved_at = self._data['saved_at']
+                    logger.warning("📦 Каталог читается из снимка (%s аниме)", len(self._data['anime']))
+        return self._data is not None
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), self.interval)
+                await asyncio.sleep(self.delay)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Не удалось обновить снимок каталога: %s", e)
+
+    def start(self):
+        if self.path and self._task is None:
+            if not os.path.exists(self.path):
+                self._dirty.set()
+            self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # Чтение каталога в формате запросов к БД
+    def anime_details(self, anime_id):
+        return self._data['anime'].get(anime_id)
+
+    def search_rows(self):
+        return [row[:4] for row in self._data['anime'].values()]
+
+    def anime_page(self, direction, cursor):
+        order = self._data['order']
+        if cursor is None:
+            rows = order[:PAGE_SIZE + 1]
+        elif cursor not in self._data['anime']:
+            rows = []
+        else:
+            key = (self._data['anime'][cursor][1], cursor)
+            if direction == 'next':
+                start = bisect.bisect_right(order, key)
+                rows = order[start:start + PAGE_SIZE + 1]
+            else:
+                end = bisect.bisect_left(order, key)
+                rows = order[max(0, end - PAGE_SIZE - 1):end][::-1]
+        return _make_page([(anime_id, title) for title, anime_id in rows], direction, cursor)
+
+    def episodes_page(self, anime_id, direction, cursor):
+        numbers = self._data['numbers'].get(anime_id, [])
+        if cursor is None:
+            page = numbers[:PAGE_SIZE + 1]
+        elif direction == 'next':
+            start = bisect.bisect_right(numbers, cursor)
+            page = numbers[start:start + PAGE_SIZE + 1]
+        else:
+            end = bisect.bisect_left(numbers, cursor)
+            page = numbers[max(0, end - PAGE_SIZE - 1):end][::-1]
+        return _make_page(page, direction, cursor)
+
+    def count_episodes(self, anime_id):
+        return len(self._data['numbers'].get(anime_id, ()))
+
+    def episode(self, anime_id, number):
+        return self._data['episodes'].get(anime_id, {}).get(number)
+
+catalog_snapshot = CatalogSnapshot(SNAPSHOT_FILE, SNAPSHOT_INTERVAL, SNAPSHOT_DELAY)
+
+async def with_snapshot(loader, fallback, *args):
+    """Выполняет loader(), а при недоступной БД отвечает fallback(*args) из снимка."""
+    try:
+        return await loader()
+    except DB_UNAVAILABLE_ERRORS:
+        if not await catalog_snapshot.ensure_loaded():
+            raise
+        SNAPSHOT_READS.inc(fallback.__name__)
+        return fallback(*args)
+
+# ===================== Функции работы с PostgreSQL =====================
+# Счётчики строк поддерживаются триггерами, поэтому статистика не делает COUNT(*)
+STATS_COUNTERS_SQL = (
+    '''
+    CREATE TABLE stats_counters (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION stats_count_rows() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE stats_counters SET value = value + 1 WHERE name = TG_TABLE_NAME;
+        ELSE
+            UPDATE stats_counters SET value = value - 1 WHERE name = TG_TABLE_NAME;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION stats_count_admins() RETURNS trigger AS $$
+    DECLARE
+        delta INTEGER := 0;
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_admin THEN
+            delta := delta + 1;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.is_admin THEN
+            delta := delta - 1;
+        END IF;
+        IF delta <> 0 THEN
+            UPDATE stats_counters SET value = value + delta WHERE name = 'admins';
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    "CREATE TRIGGER anime_stats AFTER INSERT OR DELETE ON anime "
+    "FOR EACH ROW EXECUTE FUNCTION stats_count_rows()",
+    "CREATE TRIGGER episodes_stats AFTER INSERT OR DELETE ON episodes "
+    "FOR EACH ROW EXECUTE FUNCTION stats_count_rows()",
+    "CREATE TRIGGER users_stats AFTER INSERT OR DELETE ON users "
+    "FOR EACH ROW EXECUTE FUNCTION stats_count_rows()",
+    "CREATE TRIGGER users_admins_stats AFTER INSERT OR DELETE OR UPDATE OF is_admin ON users "
+    "FOR EACH ROW EXECUTE FUNCTION stats_count_admins()",
+    # Заполняем после создания триггеров: они блокируют таблицы до конца транзакции
+    '''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'anime', COUNT(*) FROM anime
+    UNION ALL SELECT 'episodes', COUNT(*) FROM episodes
+    UNION ALL SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'admins', COUNT(*) FROM users WHERE is_admin = TRUE
+    ''',
+)
+# Сколько последних аниме и серий показывать в статистике
+STATS_NEWEST = 3
+
+# Миграции схемы: (версия, описание, функция(cursor)). Каждая применяется в своей
+# транзакции и записывается в schema_version. Миграции 1-7 повторяют прежний
+# init_db и написаны идемпотентно: базы, созданные до появления schema_version,
+# проходят их без изменений.
+MIGRATIONS = []
+# Ключ pg_advisory_lock: несколько экземпляров бота не мигрируют одновременно
+SCHEMA_LOCK_ID = 0x76786462
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+@migration(1, 'таблицы anime, episodes, users')
+def _migration_base_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS anime (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT,
+            cover_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS episodes (
+            id SERIAL PRIMARY KEY,
+            anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            video_url TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            is_admin BOOLEAN DEFAULT FALSE,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(2, 'file_id обложек и серий')
+def _migration_file_ids(cursor):
+    # file_id загруженных в Telegram файлов: повторная отправка без скачивания по URL
+    cursor.execute("ALTER TABLE anime ADD COLUMN IF NOT EXISTS cover_file_id TEXT")
+    cursor.execute("ALTER TABLE episodes ADD COLUMN IF NOT EXISTS file_id TEXT")
+
+@migration(3, 'индексы для страниц каталога и DAU/WAU')
+def _migration_catalog_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS anime_title_id_idx ON anime (title, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_last_active_idx ON users (last_active)")
+
+@migration(4, 'уникальный номер серии внутри аниме')
+def _migration_unique_episodes(cursor):
+    cursor.execute("SELECT to_regclass('episodes_anime_number_idx')")
+    if cursor.fetchone()[0] is None:
+        # Перед созданием уникального индекса убираем дубликаты, оставляя последнюю запись
+        cursor.execute('''
+            DELETE FROM episodes a USING episodes b
+            WHERE a.anime_id = b.anime_id AND a.number = b.number AND a.id < b.id
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX episodes_anime_number_idx ON episodes (anime_id, number)"
+        )
+
+@migration(5, 'подписки и очередь рассылки')
+def _migration_subscriptions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id BIGINT NOT NULL,
+            anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+            PRIMARY KEY (anime_id, user_id)
+        )
+    ''')
+    # Очередь рассылки хранится в БД и переживает перезапуск бота
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_queue (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(6, 'счётчики статистики на триггерах')
+def _migration_stats_counters(cursor):
+    cursor.execute("SELECT to_regclass('stats_counters')")
+    if cursor.fetchone()[0] is None:
+        for statement in STATS_COUNTERS_SQL:
+            cursor.execute(statement)
+
+@migration(7, 'состояние админских диалогов')
+def _migration_user_state(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id BIGINT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(8, 'история просмотров')
+def _migration_watch_history(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS watch_history (
+            user_id BIGINT NOT NULL,
+            anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, anime_id)
+        )
+    ''')
+
+@migration(9, 'захват записей очереди рассылки')
+def _migration_notification_claims(cursor):
+    cursor.execute("ALTER TABLE notification_queue ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP")
+
+# Ссылки на файлы Bot API содержат токен бота и истекают примерно через час
+TELEGRAM_FILE_URL = 'api.telegram.org/file/bot'
+
+@migration(10, 'удаление ссылок на файлы Bot API с токеном бота')
+def _migration_telegram_file_urls(cursor):
+    # Раньше серии-видео сохранялись как file_path; без file_id такую серию нужно загрузить заново
+    cursor.execute(
+        "UPDATE episodes SET video_url = '' WHERE video_url LIKE %s",
+        (f"%{TELEGRAM_FILE_URL}%",)
+    )
+
+SCHEMA_VERSION = max(version for version, _, _ in MIGRATIONS)
+
+def _schema_version(conn):
+    """Текущая версия схемы; 0 — таблицы schema_version ещё нет."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schema_version')")
+        if cursor.fetchone()[0] is None:
+            return 0
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cursor.fetchone()[0]
+
+def _apply_migrations(conn):
+    applied_now = []
+    with conn.cursor() as cursor:
+        # Блокировка сессионная: переживает коммиты отдельных миграций
+        cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            # Перечитываем под блокировкой: другой экземпляр мог уже всё применить
+            cursor.execute("SELECT version FROM schema_version")
+            applied = {row[0] for row in cursor.fetchall()}
+            for version, description, migrate in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                try:
+                    migrate(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied_now.append(version)
+                logger.info("🧱 Применена миграция %s: %s", version, description)
+        finally:
+            conn.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+    return applied_now
+
+async def init_db():
+    # Быстрый путь: схема актуальна — никаких DDL и блокировок при старте
+    version = await db.run(_schema_version)
+    if version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            logger.warning("⚠️ Схема БД новее кода бота (%s > %s)", version, SCHEMA_VERSION)
+        logger.info("✅ База данных готова (схема версии %s)", version)
+        return
+    # Миграция (например, индекс на большой таблице) может идти дольше обычного запроса
+    applied = await db.run(_apply_migrations, timeout=0)
+    logger.info(
+        "✅ База данных обновлена до версии %s (применено миграций: %s)",
+        SCHEMA_VERSION, len(applied)
+    )
+
+_db_ready = False
+
+async def prepare_database():
+    """Запускает пул и создаёт таблицы один раз.
+
+    Вызывается из post_init и из PostgresPersistence, которую Application
+    загружает раньше post_init.
+    """
+    global _db_ready
+    if _db_ready:
+        return
+    try:
+        await asyncio.to_thread(db.start)
+    except DB_UNAVAILABLE_ERRORS:
+        db.breaker.trip()
+        raise
+    await init_db()
+    _db_ready = True
+
+async def add_anime(title, description, cover_url):
+    row = await db.fetchone(
+        "INSERT INTO anime (title, description, cover_url) VALUES (%s, %s, %s) RETURNING id",
+        (title, description, cover_url)
+    )
+    anime_id = row[0]
+    catalog_cache.invalidate_prefix('anime_page')
+    search_index.add(anime_id, title, description, cover_url)
+    render_cache.bump()
+    catalog_snapshot.mark_dirty()
+    # Аргументы вместо f-строки: записи, отброшенные фильтрами, не форматируются
+    logger.info("➕ Аниме добавлено: %s (ID: %s)", title, anime_id, extra={'category': 'catalog'})
+    return anime_id
+
+async def get_anime_details(anime_id):
+    return await catalog_cache.get_or_load(
+        ('anime', anime_id),
+        lambda: with_snapshot(
+            lambda: db.fetchone(
+                "SELECT id, title, description, cover_url, cover_file_id FROM anime WHERE id = %s",
+                (anime_id,)
+            ),
+            catalog_snapshot.anime_details, anime_id
+        )
+    )
+
+async def set_cover_file_id(anime_id, file_id):
+    try:
+        await db.execute("UPDATE anime SET cover_file_id = %s WHERE id = %s", (file_id, anime_id))
+    except DB_UNAVAILABLE_ERRORS:
+        # file_id — лишь ускорение повторной отправки, без БД его можно не сохранять
+        logger.warning("file_id обложки аниме %s не сохранён: БД недоступна", anime_id)
+        return
+    catalog_cache.invalidate(('anime', anime_id))
+
+def _make_page(rows, direction, cursor):
+    """Превращает выборку из PAGE_SIZE + 1 строк в (rows, has_prev, has_next)."""
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if direction == 'prev':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor is not None, has_more
+
+async def _fetch_anime_page(direction, cursor):
+    if cursor is None:
+        rows = await db.fetchall(
+            "SELECT id, title FROM anime ORDER BY title, id LIMIT %s",
+            (PAGE_SIZE + 1,)
+        )
+    elif direction == 'next':
+        rows = await db.fetchall(
+            "SELECT id, title FROM anime "
+            "WHERE (title, id) > (SELECT title, id FROM anime WHERE id = %s) "
+            "ORDER BY title, id LIMIT %s",
+            (cursor, PAGE_SIZE + 1)
+        )
+    else:
+        rows = await db.fetchall(
+            "SELECT id, title FROM anime "
+            "WHERE (title, id) < (SELECT title, id FROM anime WHERE id = %s) "
+            "ORDER BY title DESC, id DESC LIMIT %s",
+            (cursor, PAGE_SIZE + 1)
+        )
+    return _make_page(rows, direction, cursor)
+
+async def get_anime_page(direction='next', cursor=None):
+    """Страница списка аниме (keyset-пагинация по (title, id)).
+
+    cursor — id крайнего аниме предыдущей страницы, direction — 'next' или 'prev'.
+    """
+    return await catalog_cache.get_or_load(
+        ('anime_page', direction, cursor),
+        lambda: with_snapshot(
+            lambda: _fetch_anime_page(direction, cursor),
+            catalog_snapshot.anime_page, direction, cursor
+        )
+    )
+
+async def _fetch_episodes_page(anime_id, direction, cursor):
+    if cursor is None:
+        rows = await db.fetchall(
+            "SELECT number FROM episodes WHERE anime_id = %s ORDER BY number LIMIT %s",
+            (anime_id, PAGE_SIZE + 1)
+        )
+    elif direction == 'next':
+        rows = await db.fetchall(
+            "SELECT number FROM episodes WHERE anime_id = %s AND number > %s "
+            "ORDER BY number LIMIT %s",
+            (anime_id, cursor, PAGE_SIZE + 1)
+        )
+    else:
+        rows = await db.fetchall(
+            "SELECT number FROM episodes WHERE anime_id = %s AND number < %s "
+            "ORDER BY number DESC LIMIT %s",
+            (anime_id, cursor, PAGE_SIZE + 1)
+        )
+    numbers, has_prev, has_next = _make_page(rows, direction, cursor)
+    return [number for number, in numbers], has_prev, has_next
+
+async def get_episodes_page(anime_id, direction='next', cursor=None):
+    """Страница номеров серий (keyset-пагинация по number)."""
+    return await catalog_cache.get_or_load(
+        ('episodes_page', anime_id, direction, cursor),
+        lambda: with_snapshot(
+            lambda: _fetch_episodes_page(anime_id, direction, cursor),
+            catalog_snapshot.episodes_page, anime_id, direction, cursor
+        )
+    )
+
+async def count_episodes(anime_id):
+    async def _count():
+        row = await db.fetchone("SELECT COUNT(*) FROM episodes WHERE anime_id = %s", (anime_id,))
+        return row[0]
+    return await catalog_cache.get_or_load(
+        ('episodes_count', anime_id),
+        lambda: with_snapshot(_count, catalog_snapshot.count_episodes, anime_id)
+    )
+
+async def get_episode(anime_id, number):
+    return await catalog_cache.get_or_load(
+        ('episode', anime_id, number),
+        lambda: with_snapshot(
+            lambda: db.fetchone(
+                "SELECT video_url, file_id FROM episodes WHERE anime_id = %s AND number = %s",
+                (anime_id, number)
+            ),
+            catalog_snapshot.episode, anime_id, number
+        )
+    )
+
+async def set_episode_file_id(anime_id, number, file_id):
+    try:
+        await db.execute(
+            "UPDATE episodes SET file_id = %s WHERE anime_id = %s AND number = %s",
+            (file_id, anime_id, number)
+        )
+    except DB_UNAVAILABLE_ERRORS:
+        logger.warning("file_id серии %s аниме %s не сохранён: БД недоступна", number, anime_id)
+        return
+    catalog_cache.invalidate(('episode', anime_id, number))
+
+def invalidate_episodes(anime_id, number=None):
+    """Сбрасывает кэш серий аниме; без number — всех отдельных серий."""
+    catalog_cache.invalidate(('episodes_count', anime_id))
+    catalog_cache.invalidate_prefix('episodes_page', anime_id)
+    if number is None:
+        catalog_cache.invalidate_prefix('episode', anime_id)
+    else:
+        catalog_cache.invalidate(('episode', anime_id, number))
+
+def _upsert_episode(conn, anime_id, number, video_url, file_id):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM episodes WHERE anime_id = %s AND number = %s",
+            (anime_id, number)
+        )
+        exists = cursor.fetchone() is not None
+        cursor.execute(
+            "INSERT INTO episodes (anime_id, number, video_url, file_id) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (anime_id, number) DO UPDATE "
+            "SET video_url = EXCLUDED.video_url, file_id = EXCLUDED.file_id",
+            (anime_id, number, video_url, file_id)
+        )
+        # Уведомления ставятся в той же транзакции: серия не сохранится без них и наоборот
+        queued = 0 if exists else _queue_notifications(cursor, anime_id, number)
+    return not exists, queued
+
+async def add_episode(anime_id, number, video_url, file_id=None):
+    """Добавляет или заменяет серию, для новой — уведомляет подписчиков.
+
+    Возвращает True, если серия новая.
+    """
+    created, queued = await db.run(_upsert_episode, anime_id, number, video_url, file_id)
+    if queued:
+        broadcaster.wake()
+    invalidate_episodes(anime_id, number)
+    render_cache.bump()
+    catalog_snapshot.mark_dirty()
+    logger.info("➕ Серия %s добавлена для аниме ID %s", number, anime_id, extra={'category': 'catalog'})
+    return created
+
+def _import_episodes(conn, anime_id, rows):
+    with conn.cursor() as cursor:
+        # xmax = 0 только у вставленных строк, у обновлённых в нём id транзакции
+        _execute_values(
+            cursor,
+            "INSERT INTO episodes (anime_id, number, video_url) VALUES {values} "
+            "ON CONFLICT (anime_id, number) DO UPDATE "
+            "SET video_url = EXCLUDED.video_url, file_id = NULL "
+            "RETURNING number, (xmax = 0)",
+            [(anime_id, number, url) for number, url in rows]
+        )
+        results = sorted(cursor.fetchall())
+        inserted = [number for number, created in results if created]
+        updated = [number for number, created in results if not created]
+        # Одно уведомление подписчикам о самой новой из добавленных серий
+        queued = _queue_notifications(cursor, anime_id, max(inserted)) if inserted else 0
+    return inserted, updated, queued
+
+async def import_episodes(anime_id, rows):
+    """Пакетно добавляет серии [(номер, ссылка)] одним запросом.
+
+    Возвращает списки номеров добавленных и обновлённых серий.
+    """
+    inserted, updated, queued = await db.run(_import_episodes, anime_id, rows)
+    if queued:
+        broadcaster.wake()
+    invalidate_episodes(anime_id)
+    render_cache.bump()
+    catalog_snapshot.mark_dirty()
+    logger.info(
+        "➕ Импорт серий для аниме ID %s: добавлено %s, обновлено %s",
+        anime_id, len(inserted), len(updated), extra={'category': 'catalog'}
+    )
+    return inserted, updated
+
+async def set_admin(user_id):
+    await db.execute(
+        "INSERT INTO users (user_id, is_admin) VALUES (%s, TRUE) "
+        "ON CONFLICT (user_id) DO UPDATE SET is_admin = EXCLUDED.is_admin",
+        (user_id,)
+    )
+    admin_cache.add(user_id)
+    logger.info("👑 Админские права выданы пользователю ID: %s", user_id)
+
+async def is_admin(user_id):
+    return await admin_cache.contains(user_id)
+
+def _read_stats(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name, value FROM stats_counters")
+        stats = dict(cursor.fetchall())
+
+        cursor.execute("SELECT title FROM anime ORDER BY id DESC LIMIT %s", (STATS_NEWEST,))
+        stats['newest_anime'] = [title for title, in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT a.title, e.number FROM episodes e JOIN anime a ON a.id = e.anime_id "
+            "ORDER BY e.id DESC LIMIT %s",
+            (STATS_NEWEST,)
+        )
+        stats['newest_episodes'] = cursor.fetchall()
+    return stats
+
+def _count_active(conn, day_ago, week_ago):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE last_active >= %s", (day_ago,))
+        dau = cursor.fetchone()[0]
+
+        cursor.execute("SELECT COUNT(*) FROM users WHERE last_active >= %s", (week_ago,))
+        wau = cursor.fetchone()[0]
+    return dau, wau
+
+async def get_stats():
+    """Счётчики из stats_counters и последние добавления — без полного сканирования."""
+    return await db.run(_read_stats)
+
+# DAU/WAU не зависят от каталога: свой кэш, чтобы не искажать его статистику
+ACTIVE_USERS_TTL = 60
+active_users_cache = TTLCache(1, ACTIVE_USERS_TTL)
+
+async def get_active_users():
+    """DAU/WAU по индексу last_active; результат кэшируется на ACTIVE_USERS_TTL."""
+    async def _load():
+        now = _utc_from_timestamp(time.time())
+        return await db.run(_count_active, now - timedelta(days=1), now - timedelta(days=7))
+    return await active_users_cache.get_or_load(('active_users',), _load)
+
+# ===================== Пакетный импорт серий =====================
+# Импорт идёт одним INSERT, а у запроса PostgreSQL не больше 65535 параметров (по 3 на строку)
+BULK_IMPORT_MAX_ROWS = min(int(os.getenv('BULK_IMPORT_MAX_ROWS', '1000')), 65535 // 3)
+BULK_IMPORT_MAX_BYTES = int(os.getenv('BULK_IMPORT_MAX_BYTES', str(1024 * 1024)))
+# Столбец number имеет тип INTEGER
+MAX_EPISODE_NUMBER = 2 ** 31 - 1
+
+def validate_episode_rows(raw_rows):
+    """Проверяет строки (позиция, номер, ссылка) за один проход.
+
+    Возвращает ([(номер, ссылка)], [(позиция, причина)]).
+    """
+    rows = []
+    rejected = []
+    seen = set()
+    for position, number, url in raw_rows:
+        try:
+            number = int(str(number).strip())
+        except ValueError:
+            rejected.append((position, "номер серии должен быть числом"))
+            continue
+        url = url.strip() if isinstance(url, str) else ''
+        if number <= 0:
+            rejected.append((position, "номер серии должен быть больше нуля"))
+        elif number > MAX_EPISODE_NUMBER:
+            rejected.append((position, "слишком большой номер серии"))
+        elif not url:
+            rejected.append((position, "нет ссылки"))
+        elif TELEGRAM_FILE_URL in url:
+            rejected.append((position, "ссылка на файл Telegram содержит токен бота, пришлите видео"))
+        elif number in seen:
+            rejected.append((position, f"серия {number} уже есть в этом списке"))
+        elif len(rows) >= BULK_IMPORT_MAX_ROWS:
+            rejected.append((position, f"больше {BULK_IMPORT_MAX_ROWS} строк"))
+        else:
+            seen.add(number)
+            rows.append((number, url))
+    return rows, rejected
+
+def parse_episode_lines(text):
+    """Строки вида «Номер | Ссылка»; пустые строки пропускаются."""
+    raw_rows = []
+    for position, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        parts = line.split('|', 1)
+        raw_rows.append((position, parts[0], parts[1] if len(parts) > 1 else ''))
+    return validate_episode_rows(raw_rows)
+
+def parse_episode_document(filename, data):
+    """CSV (номер,ссылка) или JSON ([{"number": 1, "url": "..."}] или {"1": "..."})."""
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        payload = json.loads(text)
+        if isinstance(payload, dict):
+            return validate_episode_rows(
+                (position, number, url) for position, (number, url) in enumerate(payload.items(), 1)
+            )
+        if not isinstance(payload, list):
+            raise ValueError("ожидается список серий или объект «номер: ссылка»")
+        raw_rows = []
+        malformed = []
+        for position, item in enumerate(payload, 1):
+            if isinstance(item, dict):
+                raw_rows.append((position, item.get('number'), item.get('url')))
+            elif isinstance(item, list) and len(item) >= 2:
+                raw_rows.append((position, item[0], item[1]))
+            else:
+                malformed.append((position, "ожидается объект {number, url} или пара [номер, ссылка]"))
+        rows, rejected = validate_episode_rows(raw_rows)
+        return rows, sorted(malformed + rejected)
+
+    dialect = csv.Sniffer().sniff(text[:1024], delimiters=',;|\t')
+    raw_rows = []
+    for position, record in enumerate(csv.reader(text.splitlines(), dialect), 1):
+        if not record or not any(field.strip() for field in record):
+            continue
+        # Необязательная строка заголовка
+        if position == 1 and not record[0].strip().isdigit():
+            continue
+        raw_rows.append((position, record[0], record[1] if len(record) > 1 else ''))
+    return validate_episode_rows(raw_rows)
+
+def format_import_report(inserted, updated, rejected):
+    lines = [
+        "📦 <b>Импорт серий завершён</b>\n",
+        f"• ➕ Добавлено: <b>{len(inserted)}</b>",
+        f"• ♻️ Обновлено: <b>{len(updated)}</b>",
+        f"• ❌ Отклонено: <b>{len(rejected)}</b>",
+    ]
+    for position, reason in rejected[:10]:
+        lines.append(f"  строка {position}: {html.escape(reason)}")
+    if len(rejected) > 10:
+        lines.append(f"  … и ещё {len(rejected) - 10}")
+    return "\n".join(lines)
+
+# ===================== Подписки и рассылка =====================
+# Глобальный лимит Telegram ~30 сообщений/с, в один чат — не чаще раза в секунду
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', '1'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', '3'))
+# Как часто проверять очередь без сигнала (например, записи от другого экземпляра бота)
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', '30'))
+# На сколько секунд экземпляр забирает пачку себе; после сбоя её дошлёт другой
+BROADCAST_LEASE = float(os.getenv('BROADCAST_LEASE', '300'))
+
+def _toggle_subscription(conn, user_id, anime_id):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM subscriptions WHERE user_id = %s AND anime_id = %s",
+            (user_id, anime_id)
+        )
+        if cursor.rowcount:
+            return False
+        cursor.execute(
+            "INSERT INTO subscriptions (user_id, anime_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (user_id, anime_id)
+        )
+    return True
+
+async def toggle_subscription(user_id, anime_id):
+    """Подписывает или отписывает пользователя. Возвращает True, если теперь подписан."""
+    return await db.run(_toggle_subscription, user_id, anime_id)
+
+def _queue_notifications(cursor, anime_id, number):
+    """Раскладывает уведомление по подписчикам одним INSERT ... SELECT."""
+    cursor.execute(
+        "INSERT INTO notification_queue (chat_id, anime_id, number) "
+        "SELECT user_id, %s, %s FROM subscriptions WHERE anime_id = %s",
+        (anime_id, number, anime_id)
+    )
+    return cursor.rowcount
+
+def _enqueue_episode_notifications(conn, anime_id, number):
+    with conn.cursor() as cursor:
+        return _queue_notifications(cursor, anime_id, number)
+
+async def enqueue_episode_notifications(anime_id, number):
+    count = await db.run(_enqueue_episode_notifications, anime_id, number)
+    if count:
+        broadcaster.wake()
+    return count
+
+def _claim_notifications(conn, limit, now, lease_until):
+    """Забирает пачку незанятых записей очереди до lease_until.
+
+    SKIP LOCKED пропускает строки, которые в этот момент захватывает другой
+    экземпляр бота, поэтому пачки разных экземпляров не пересекаются.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, chat_id, anime_id, number FROM notification_queue "
+            "WHERE claimed_until IS NULL OR claimed_until < %s "
+            "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+            (now, limit)
+        )
+        rows = cursor.fetchall()
+        if rows:
+            cursor.execute(
+                f"UPDATE notification_queue SET claimed_until = %s "
+                f"WHERE id IN ({_placeholders(len(rows))})",
+                [lease_until] + [row[0] for row in rows]
+            )
+        return rows
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Берёт токен без ожидания; False, если токенов нет."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Broadcaster:
+    """Фоновая рассылка уведомлений из notification_queue.
+
+    Соблюдает глобальный лимит (token bucket) и интервал между сообщениями в
+    один чат, при RetryAfter приостанавливает всю рассылку. Пачка
+    захватывается на lease секунд, чтобы несколько экземпляров бота не
+    рассылали одно и то же. Записи удаляются из очереди только после
+    обработки, поэтому после перезапуска рассылка продолжается (сообщение
+    может прийти повторно, но не потеряется).
+    """
+
+    def __init__(self, rate, chat_interval, batch_size, concurrency, max_attempts, poll_interval, lease):
+        # Без запаса: иначе поверх rate в первую секунду уходит ещё rate сообщений
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.chat_interval = chat_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.busy_seconds = 0.0
+        self._senders = asyncio.Semaphore(concurrency)
+        self._chat_ready = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+
+    @property
+    def throughput(self):
+        return self.sent / self.busy_seconds if self.busy_seconds else 0.0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error("Ошибка рассылки уведомлений: %s", e)
+                processed = 0
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def process_batch(self):
+        """Отправляет одну пачку из очереди. Возвращает число обработанных записей."""
+        now = time.time()
+        rows = await db.run(
+            _claim_notifications, self.batch_size,
+            _utc_from_timestamp(now), _utc_from_timestamp(now + self.lease)
+        )
+        if not rows:
+            return 0
 
-# Загружаем переменные окружения из .env
-load_dotenv()
+        started = time.monotonic()
+        # Куча (время готовности чата, id, запись, попытка)
+        heap = [(0.0, row[0], row, 1) for row in rows]
+        heapq.heapify(heap)
+        done = []
+        tasks = set()
+        while heap or tasks:
+            if not heap:
+                finished, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    self._handle_result(task.result(), heap, done)
+                continue
+            ready_at, row_id, row, attempt = heapq.heappop(heap)
+            chat_ready = self._chat_ready.get(row[1], 0.0)
+            if chat_ready > ready_at:
+                heapq.heappush(heap, (chat_ready, row_id, row, attempt))
+                continue
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.bucket.acquire()
+            self._chat_ready[row[1]] = time.monotonic() + self.chat_interval
+            await self._senders.acquire()
+            tasks.add(asyncio.create_task(self._send(row, attempt)))
+            finished = {task for task in tasks if task.done()}
+            tasks -= finished
+            for task in finished:
+                self._handle_result(task.result(), heap, done)
 
-# Загрузка переменных окружения
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
-DATABASE_URL = os.getenv('DATABASE_URL')
+        await db.execute(
+            f"DELETE FROM notification_queue WHERE id IN ({_placeholders(len(done))})",
+            done
+        )
+        self.busy_seconds += time.monotonic() - started
+        self._chat_ready = {
+            chat_id: ready for chat_id, ready in self._chat_ready.items() if ready > time.monotonic()
+        }
+        return len(rows)
 
-# Проверка переменных
-if not BOT_TOKEN:
-    print("ERROR: BOT_TOKEN not set!")
-    sys.exit(1)
+    def _handle_result(self, result, heap, done):
+        row, attempt, retry_at = result
+        if retry_at is None or attempt >= self.max_attempts:
+            done.append(row[0])
+        else:
+            heapq.heappush(heap, (retry_at, row[0], row, attempt + 1))
 
-if not DATABASE_URL:
-    print("ERROR: DATABASE_URL not set!")
-    sys.exit(1)
+    async def _send(self, row, attempt):
+        """Возвращает (запись, попытка, время повтора или None, если повтор не нужен)."""
+        row_id, chat_id, anime_id, number = row
+        try:
+            anime = await get_anime_details(anime_id)
+            if not anime:
+                return row, attempt, None
+            await self._bot.send_message(
+                chat_id=chat_id,
+                text=f"🔔 Вышла серия {number} аниме «{anime[1]}»",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                    f"▶️ Серия {number}", callback_data=f"episode_{anime_id}_{number}"
+                )]])
+            )
+            self.sent += 1
+            return row, attempt, None
+        except RetryAfter as e:
+            # Флуд-лимит общий для бота: останавливаем всю рассылку, попытку не тратим
+            self.bucket.pause(e.retry_after)
+            self.retries += 1
+            return row, attempt - 1, time.monotonic() + e.retry_after
+        except Forbidden:
+            # Пользователь заблокировал бота — подписки больше не нужны
+            self.failed += 1
+            try:
+                await db.execute("DELETE FROM subscriptions WHERE user_id = %s", (chat_id,))
+            except Exception as e:
+                logger.error("Не удалось удалить подписки чата %s: %s", chat_id, e)
+            return row, attempt, None
+        except Exception as e:
+            self.retries += 1
+            if attempt >= self.max_attempts:
+                self.failed += 1
+                logger.error("Не удалось отправить уведомление в чат %s: %s", chat_id, e)
+            return row, attempt, time.monotonic() + attempt
+        finally:
+            self._senders.release()
 
-# Настройка логгирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+broadcaster = Broadcaster(
+    BROADCAST_RATE, BROADCAST_CHAT_INTERVAL, BROADCAST_BATCH_SIZE,
+    BROADCAST_CONCURRENCY, BROADCAST_MAX_ATTEMPTS, BROADCAST_POLL_INTERVAL, BROADCAST_LEASE
 )
-logger = logging.getLogger(__name__)
 
-# ===================== Функции работы с PostgreSQL =====================
-def get_connection():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+# ===================== Отправка обложек =====================
+COVER_CONCURRENCY = int(os.getenv('COVER_CONCURRENCY', '4'))
+# Сколько секунд ждать, пока Telegram скачает и отправит обложку
+COVER_TIMEOUT = float(os.getenv('COVER_TIMEOUT', '20'))
+COVER_QUEUE_SIZE = int(os.getenv('COVER_QUEUE_SIZE', '1000'))
 
-def init_db():
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS anime (
-                    id SERIAL PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    description TEXT,
-                    cover_url TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS episodes (
-                    id SERIAL PRIMARY KEY,
-                    anime_id INTEGER REFERENCES anime(id) ON DELETE CASCADE,
-                    number INTEGER NOT NULL,
-                    video_url TEXT NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    is_admin BOOLEAN DEFAULT FALSE,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-        conn.commit()
-    logger.info("✅ База данных инициализирована")
+class CoverSender:
+    """Фоновая отправка обложек: обработчик не ждёт, пока Telegram скачает картинку.
 
-def add_anime(title, description, cover_url):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO anime (title, description, cover_url) VALUES (%s, %s, %s) RETURNING id",
-                (title, description, cover_url)
-            )
-            anime_id = cursor.fetchone()[0]
-        conn.commit()
-    logger.info(f"➕ Аниме добавлено: {title} (ID: {anime_id})")
-    return anime_id
+    Задачи складываются в ограниченную очередь и выполняются не более чем
+    concurrency воркерами, каждая с таймаутом. Если обложка ушла по URL,
+    полученный file_id сохраняется, и следующие отправки идут без скачивания.
+    """
 
-def get_anime_list():
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, title FROM anime ORDER BY title")
-            return cursor.fetchall()
-
-def get_anime_details(anime_id):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, title, description, cover_url FROM anime WHERE id = %s", (anime_id,))
-            return cursor.fetchone()
-
-def get_episodes(anime_id):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT number, video_url FROM episodes WHERE anime_id = %s ORDER BY number", (anime_id,))
-            return cursor.fetchall()
-
-def add_episode(anime_id, number, video_url):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO episodes (anime_id, number, video_url) VALUES (%s, %s, %s)",
-                (anime_id, number, video_url)
-            )
-        conn.commit()
-    logger.info(f"➕ Серия {number} добавлена для аниме ID {anime_id}")
+    def __init__(self, concurrency, timeout, queue_size):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._bot = None
+        self._queue = None
+        self._workers = []
 
-def set_admin(user_id):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO users (user_id, is_admin) VALUES (%s, TRUE) "
-                "ON CONFLICT (user_id) DO UPDATE SET is_admin = EXCLUDED.is_admin",
-                (user_id,)
+    def enqueue(self, chat_id, anime_id, cover_url, cover_file_id, caption, reply_to_message_id=None):
+        """Ставит обложку в очередь; False, если отправщик не запущен или очередь полна."""
+        if not self._workers:
+            return False
+        try:
+            self._queue.put_nowait(
+                (chat_id, anime_id, cover_url, cover_file_id, caption, reply_to_message_id)
             )
-        conn.commit()
-    logger.info(f"👑 Админские права выданы пользователю ID: {user_id}")
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Очередь обложек переполнена, обложка аниме %s пропущена", anime_id)
+            return False
+        return True
+
+    async def _send(self, chat_id, anime_id, cover_url, cover_file_id, caption, reply_to_message_id):
+        message = await self._bot.send_photo(
+            chat_id=chat_id,
+            photo=cover_file_id or cover_url,
+            caption=caption,
+            reply_to_message_id=reply_to_message_id,
+            read_timeout=self.timeout
+        )
+        if not cover_file_id and message.photo:
+            await set_cover_file_id(anime_id, message.photo[-1].file_id)
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await asyncio.wait_for(self._send(*job), self.timeout)
+                self.sent += 1
+            except asyncio.TimeoutError:
+                self.failed += 1
+                logger.warning("Обложка аниме %s не отправлена за %g с", job[1], self.timeout)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Ошибка при отправке обложки: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def start(self, bot):
+        self._bot = bot
+        if not self._workers:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def drain(self):
+        """Ждёт, пока очередь опустеет (для бенчмарков и остановки)."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
 
-def is_admin(user_id):
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT is_admin FROM users WHERE user_id = %s", (user_id,))
-            result = cursor.fetchone()
-            return result and result[0]
+    def __len__(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+cover_sender = CoverSender(COVER_CONCURRENCY, COVER_TIMEOUT, COVER_QUEUE_SIZE)
 
 # ===================== Обработчики команд =====================
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        activity_tracker.touch(update.effective_user.id)
+
+async def persist_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Следующее обновление администратора может прийти на другой экземпляр бота
+    try:
+        if update.effective_user and await is_admin(update.effective_user.id):
+            await context.application.persistence.write_through(update.effective_user.id, context.user_data)
+    except Exception as e:
+        logger.error("Ошибка в функции persist_shared_state: %s", e)
+
+async def render_anime_card(anime):
+    """Текст и клавиатура карточки аниме с первой страницей серий."""
+    anime_id, title, description, cover_url, cover_file_id = anime
+    
+    async def render():
+        # Получаем первую страницу серий
+        episodes_count = await count_episodes(anime_id)
+        page = await get_episodes_page(anime_id)
+        
+        text = (
+            f"📺 <b>{title}</b>\n\n"
+            f"{description}\n\n"
+            f"🔢 Доступно серий: {episodes_count}"
+        )
+        return text, InlineKeyboardMarkup(episodes_page_keyboard(anime_id, page))
+    return await render_cache.get_or_render(('card', anime_id), render)
+
+async def render_anime_page(direction='next', cursor=None):
+    """Клавиатура страницы списка аниме или None, если каталог пуст."""
+    async def render():
+        page = await get_anime_page(direction, cursor)
+        if not page[0] and cursor is not None:
+            # Каталог изменился, и страницы больше нет — возвращаемся к началу
+            page = await get_anime_page()
+        if not page[0]:
+            return None
+        return InlineKeyboardMarkup(anime_page_keyboard(page, "anime_", "menu_"))
+    return await render_cache.get_or_render(('menu', direction, cursor), render)
+
+async def render_episodes_page(anime_id, direction='next', cursor=None):
+    async def render():
+        page = await get_episodes_page(anime_id, direction, cursor)
+        if not page[0]:
+            page = await get_episodes_page(anime_id)
+        return InlineKeyboardMarkup(episodes_page_keyboard(anime_id, page))
+    return await render_cache.get_or_render(('episodes', anime_id, direction, cursor), render)
+
+async def menu_markup(user_id):
+    """Первая страница меню; кнопка «Продолжить» добавляется поверх общей клавиатуры."""
+    reply_markup = await render_anime_page()
+    if reply_markup is None:
+        return None
+    button = await continue_watching_button(user_id)
+    if button:
+        reply_markup = InlineKeyboardMarkup(((button,), *reply_markup.inline_keyboard))
+    return reply_markup
+
+async def continue_watching_button(user_id):
+    """Кнопка «▶️ Продолжить» со следующей серией последнего просмотренного аниме."""
+    try:
+        last = await watch_history.last(user_id)
+    except DB_UNAVAILABLE_ERRORS:
+        return None
+    if not last:
+        return None
+    anime_id, number = last
+    numbers, _, _ = await get_episodes_page(anime_id, 'next', number)
+    anime = await get_anime_details(anime_id)
+    if not numbers or not anime:
+        return None
+    title = anime[1] if len(anime[1]) <= 32 else anime[1][:31] + "…"
+    return InlineKeyboardButton(
+        f"▶️ Продолжить: {title}, серия {numbers[0]}",
+        callback_data=f"episode_{anime_id}_{numbers[0]}"
+    )
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
+    
+    # Переход по ссылке из инлайн-поиска: t.me/<бот>?start=anime_<id>
+    if context.args and context.args[0].startswith("anime_"):
+        try:
+            anime = await get_anime_details(int(context.args[0].split('_')[1]))
+            if anime:
+                text, reply_markup = await render_anime_card(anime)
+                await update.message.reply_text(text, parse_mode="HTML", reply_markup=reply_markup)
+                return
+        except Exception as e:
+            logger.error("Ошибка в функции start: %s", e)
+    
+    reply_markup = None
+    try:
+        button = await continue_watching_button(user.id)
+        if button:
+            reply_markup = InlineKeyboardMarkup([[button]])
+    except Exception as e:
+        logger.error("Ошибка в функции start: %s", e)
+    
     await update.message.reply_text(
         f"👋 Привет, {user.first_name}!\n\n"
         "Я бот для просмотра аниме от озвучки VexeraDubbing.\n"
-        "Воспользуйся командой /menu, чтобы посмотреть доступные аниме."
+        "Воспользуйся командой /menu, чтобы посмотреть доступные аниме.",
+        reply_markup=reply_markup
     )
 
+def anime_page_keyboard(page, item_prefix, nav_prefix):
+    """Кнопки аниме для страницы и строка навигации ⬅️/➡️."""
+    rows, has_prev, has_next = page
+    keyboard = [
+        [InlineKeyboardButton(title, callback_data=f"{item_prefix}{id}")]
+        for id, title in rows
+    ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"{nav_prefix}prev_{rows[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"{nav_prefix}next_{rows[-1][0]}"))
+    if nav:
+        keyboard.append(nav)
+    return keyboard
+
+def episodes_page_keyboard(anime_id, page):
+    """Кнопки серий для страницы, навигация и кнопка «Назад»."""
+    numbers, has_prev, has_next = page
+    keyboard = [
+        [InlineKeyboardButton(f"▶️ Серия {number}", callback_data=f"episode_{anime_id}_{number}")]
+        for number in numbers
+    ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"eps_{anime_id}_prev_{numbers[0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"eps_{anime_id}_next_{numbers[-1]}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔔 Подписка на новые серии", callback_data=f"sub_{anime_id}")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+    return keyboard
+
+def parse_page_callback(data):
+    """Разбирает хвост callback_data вида <...>_<next|prev>_<cursor>."""
+    _, direction, cursor = data.rsplit('_', 2)
+    return direction, int(cursor)
+
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        anime_list = get_anime_list()
+        reply_markup = await menu_markup(update.effective_user.id)
         
-        if not anime_list:
+        if reply_markup is None:
             await update.message.reply_text("📭 Список аниме пока пуст")
             return
         
-        keyboard = [
-            [InlineKeyboardButton(title, callback_data=f"anime_{id}")]
-            for id, title in anime_list
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             "🎌 Выберите аниме из списка:",
             reply_markup=reply_markup
         )
     except Exception as e:
-        logger.error(f"Ошибка в функции menu: {str(e)}")
+        logger.error("Ошибка в функции menu: %s", e)
         await update.message.reply_text("⚠️ Произошла ошибка при загрузке списка аниме")
 
+async def menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        direction, cursor = parse_page_callback(query.data)
+        reply_markup = await render_anime_page(direction, cursor)
+        
+        if reply_markup is None:
+            await query.edit_message_text("📭 Список аниме пока пуст")
+            return
+        
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
+    except Exception as e:
+        logger.error("Ошибка в функции menu_page: %s", e)
+        await query.edit_message_text("⚠️ Произошла ошибка при загрузке списка аниме")
+
 async def anime_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     try:
         anime_id = int(query.data.split('_')[1])
-        anime = get_anime_details(anime_id)
+        anime = await get_anime_details(anime_id)
         
         if not anime:
             await query.edit_message_text("⚠️ Аниме не найдено")
             return
         
-        anime_id, title, description, cover_url = anime
-        
-        # Получаем список серий
-        episodes = get_episodes(anime_id)
-        
-        keyboard = []
-        if episodes:
-            # Кнопки для каждой серии
-            for number, video_url in episodes:
-                keyboard.append([InlineKeyboardButton(f"▶️ Серия {number}", callback_data=f"episode_{anime_id}_{number}")])
-        
-        # Кнопка "Назад" в главное меню
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        anime_id, title, description, cover_url, cover_file_id = anime
+        text, reply_markup = await render_anime_card(anime)
         
         # Редактируем текущее сообщение
         await query.edit_message_text(
-            f"📺 <b>{title}</b>\n\n"
-            f"{description}\n\n"
-            f"🔢 Доступно серий: {len(episodes)}",
+            text,
             parse_mode="HTML",
             reply_markup=reply_markup
         )
         
-        # Отправляем обложку отдельно
-        if cover_url:
-            try:
-                await context.bot.send_photo(
-                    chat_id=query.message.chat_id,
-                    photo=cover_url,
-                    caption=f"🎴 Обложка: {title}",
-                    reply_to_message_id=query.message.message_id
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при отправке обложки: {str(e)}")
+        # Обложка уходит отдельным сообщением в фоне (по file_id, если Telegram её уже загружал)
+        if cover_file_id or cover_url:
+            cover_sender.enqueue(
+                query.message.chat_id, anime_id, cover_url, cover_file_id,
+                f"🎴 Обложка: {title}", reply_to_message_id=query.message.message_id
+            )
     except Exception as e:
-        logger.error(f"Ошибка в функции anime_details: {str(e)}")
+        logger.error("Ошибка в функции anime_details: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка при загрузке информации")
 
+async def episodes_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        anime_id = int(query.data.split('_')[1])
+        direction, cursor = parse_page_callback(query.data)
+        reply_markup = await render_episodes_page(anime_id, direction, cursor)
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
+    except Exception as e:
+        logger.error("Ошибка в функции episodes_page: %s", e)
+        await query.edit_message_text("⚠️ Произошла ошибка при загрузке серий")
+
+async def toggle_subscription_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    
+    try:
+        anime_id = int(query.data.split('_')[1])
+        subscribed = await toggle_subscription(query.from_user.id, anime_id)
+        if subscribed:
+            await query.answer("🔔 Вы подписались на новые серии", show_alert=True)
+        else:
+            await query.answer("🔕 Вы отписались от новых серий", show_alert=True)
+    except Exception as e:
+        logger.error("Ошибка в функции toggle_subscription_handler: %s", e)
+        await query.answer("⚠️ Произошла ошибка")
+
 async def watch_episode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -222,15 +2606,27 @@ async def watch_episode(update: Update, context: ContextTypes.DEFAULT_TYPE):
         anime_id = int(data[1])
         episode_number = int(data[2])
         
-        episodes = get_episodes(anime_id)
-        video_url = next((url for num, url in episodes if num == episode_number), None)
+        episode = await get_episode(anime_id, episode_number)
         
-        if not video_url:
+        if not episode:
             await query.edit_message_text("⚠️ Серия не найдена")
             return
         
+        video_url, file_id = episode
+        if not file_id and (not video_url or TELEGRAM_FILE_URL in video_url):
+            await query.edit_message_text("⚠️ Видео этой серии недоступно")
+            return
+        
         # Отправляем видео или ссылку
-        if video_url.startswith("http"):
+        if file_id:
+            # Видео уже загружено в Telegram
+            await context.bot.send_video(
+                chat_id=query.message.chat_id,
+                video=file_id,
+                caption=f"🎬 Серия {episode_number}",
+                supports_streaming=True
+            )
+        elif video_url.startswith("http"):
             # Для ссылок ВКонтакте и других
             await context.bot.send_message(
                 chat_id=query.message.chat_id,
@@ -238,35 +2634,82 @@ async def watch_episode(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             # Для прямых ссылок на видео
-            await context.bot.send_video(
+            message = await context.bot.send_video(
                 chat_id=query.message.chat_id,
                 video=video_url,
                 caption=f"🎬 Серия {episode_number}",
                 supports_streaming=True
             )
+            if message.video:
+                await set_episode_file_id(anime_id, episode_number, message.video.file_id)
+        
+        watch_history.record(query.from_user.id, anime_id, episode_number)
     except Exception as e:
-        logger.error(f"Ошибка в функции watch_episode: {str(e)}")
+        logger.error("Ошибка в функции watch_episode: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка при загрузке серии")
 
-async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Получаем список аниме
-        anime_list = get_anime_list()
+        text = ' '.join(context.args)
+        if not text:
+            await update.message.reply_text(
+                "🔎 Для поиска введите:\n"
+                "/search <название>\n\n"
+                "Например: /search Наруто"
+            )
+            return
         
-        if not anime_list:
-            await query.edit_message_text("📭 Список аниме пока пуст")
+        results = await search_index.search(text)
+        if not results:
+            await update.message.reply_text("🤷 Ничего не найдено")
             return
         
-        # Создаем клавиатуру с аниме
         keyboard = [
             [InlineKeyboardButton(title, callback_data=f"anime_{id}")]
-            for id, title in anime_list
+            for id, title, description, cover_url in results
         ]
+        await update.message.reply_text(
+            "🔎 Результаты поиска:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception as e:
+        logger.error("Ошибка в функции search_command: %s", e)
+        await update.message.reply_text("⚠️ Произошла ошибка при поиске")
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    
+    try:
+        results = await search_index.search(query.query)
+        articles = [
+            InlineQueryResultArticle(
+                id=str(id),
+                title=title,
+                description=(description or '')[:100],
+                thumbnail_url=cover_url or None,
+                input_message_content=InputTextMessageContent(f"📺 {title}"),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                    "▶️ Смотреть",
+                    url=f"https://t.me/{context.bot.username}?start=anime_{id}"
+                )]])
+            )
+            for id, title, description, cover_url in results
+        ]
+        await query.answer(articles, cache_time=300)
+    except Exception as e:
+        logger.error("Ошибка в функции inline_search: %s", e)
+
+async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        # Первая страница списка аниме (готовая клавиатура из кэша отрисовки)
+        reply_markup = await menu_markup(query.from_user.id)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if reply_markup is None:
+            await query.edit_message_text("📭 Список аниме пока пуст")
+            return
         
         # Редактируем текущее сообщение
         await query.edit_message_text(
@@ -274,7 +2717,7 @@ async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     except Exception as e:
-        logger.error(f"Ошибка в функции back_to_menu: {str(e)}")
+        logger.error("Ошибка в функции back_to_menu: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка при загрузке меню")
 
 # ===================== Админ-панель =====================
@@ -292,7 +2735,7 @@ async def admin_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         if args[0] == ADMIN_PASSWORD:
-            set_admin(user_id)
+            await set_admin(user_id)
             await update.message.reply_text(
                 "✅ Вы успешно авторизованы как администратор!\n"
                 "Используйте /admin для доступа к панели управления."
@@ -300,13 +2743,13 @@ async def admin_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text("❌ Неверный пароль")
     except Exception as e:
-        logger.error(f"Ошибка в функции admin_auth: {str(e)}")
+        logger.error("Ошибка в функции admin_auth: %s", e)
         await update.message.reply_text("⚠️ Произошла ошибка при авторизации")
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        if not is_admin(user_id):
+        if not await is_admin(user_id):
             await update.message.reply_text("🚫 Доступ запрещен")
             return
         
@@ -323,7 +2766,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     except Exception as e:
-        logger.error(f"Ошибка в функции admin_command: {str(e)}")
+        logger.error("Ошибка в функции admin_command: %s", e)
         await update.message.reply_text("⚠️ Произошла ошибка при загрузке панели")
 
 async def add_anime_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -331,7 +2774,7 @@ async def add_anime_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     try:
-        if not is_admin(query.from_user.id):
+        if not await is_admin(query.from_user.id):
             await query.edit_message_text("🚫 Недостаточно прав")
             return
         
@@ -345,7 +2788,7 @@ async def add_anime_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.user_data['awaiting_anime_data'] = True
     except Exception as e:
-        logger.error(f"Ошибка в функции add_anime_handler: {str(e)}")
+        logger.error("Ошибка в функции add_anime_handler: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка")
 
 async def add_episode_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -353,19 +2796,22 @@ async def add_episode_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     try:
-        if not is_admin(query.from_user.id):
+        if not await is_admin(query.from_user.id):
             await query.edit_message_text("🚫 Недостаточно прав")
             return
         
-        anime_list = get_anime_list()
-        if not anime_list:
+        if query.data == "admin_add_episode":
+            page = await get_anime_page()
+        else:
+            direction, cursor = parse_page_callback(query.data)
+            page = await get_anime_page(direction, cursor)
+            if not page[0]:
+                page = await get_anime_page()
+        if not page[0]:
             await query.edit_message_text("ℹ️ Сначала добавьте аниме")
             return
         
-        keyboard = [
-            [InlineKeyboardButton(title, callback_data=f"admin_episode_{id}")]
-            for id, title in anime_list
-        ]
+        keyboard = anime_page_keyboard(page, "admin_episode_", "admin_list_")
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_cancel")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -374,7 +2820,7 @@ async def add_episode_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=reply_markup
         )
     except Exception as e:
-        logger.error(f"Ошибка в функции add_episode_handler: {str(e)}")
+        logger.error("Ошибка в функции add_episode_handler: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка")
 
 async def receive_anime_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -395,15 +2841,19 @@ async def receive_anime_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         description = data[1].strip()
         cover_url = data[2].strip()
         
-        anime_id = add_anime(title, description, cover_url)
+        anime_id = await add_anime(title, description, cover_url)
         await update.message.reply_text(
             f"✅ Аниме <b>{title}</b> успешно добавлено!",
             parse_mode="HTML"
         )
+        # Прогрев: обложка загружается в Telegram один раз (заодно администратор
+        # видит её превью), и первый зритель получает её уже по file_id
+        if cover_url:
+            cover_sender.enqueue(update.effective_chat.id, anime_id, cover_url, None, f"🎴 Обложка: {title}")
         del context.user_data['awaiting_anime_data']
         await admin_command(update, context)
     except Exception as e:
-        logger.error(f"Ошибка в функции receive_anime_data: {str(e)}")
+        logger.error("Ошибка в функции receive_anime_data: %s", e)
         await update.message.reply_text("⚠️ Ошибка при добавлении аниме")
 
 async def select_anime_for_episode(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,6 +2861,10 @@ async def select_anime_for_episode(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
     
     try:
+        if not await is_admin(query.from_user.id):
+            await query.edit_message_text("🚫 Доступ запрещен")
+            return
+        
         anime_id = int(query.data.split('_')[2])
         context.user_data['selected_anime_id'] = anime_id
         
@@ -422,11 +2876,13 @@ async def select_anime_for_episode(update: Update, context: ContextTypes.DEFAULT
             "Пример для ссылки:\n"
             "<code>1 | https://vk.com/video-12345678_456239017</code>\n\n"
             "Пример для видеофайла:\n"
-            "<code>1</code> (в подписи к видео)",
+            "<code>1</code> (в подписи к видео)\n\n"
+            "Чтобы добавить сразу несколько серий, отправьте по одной "
+            "<code>Номер | Ссылка</code> на строку или файл .csv/.json",
             parse_mode="HTML"
         )
     except Exception as e:
-        logger.error(f"Ошибка в функции select_anime_for_episode: {str(e)}")
+        logger.error("Ошибка в функции select_anime_for_episode: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка")
 
 async def receive_episode_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -434,8 +2890,36 @@ async def receive_episode_data(update: Update, context: ContextTypes.DEFAULT_TYP
         if 'selected_anime_id' not in context.user_data:
             return
         
+        if not await is_admin(update.effective_user.id):
+            await update.message.reply_text("🚫 Доступ запрещен")
+            return
+        
         anime_id = context.user_data['selected_anime_id']
         
+        # Пакетный импорт: файл или несколько строк «Номер | Ссылка»
+        if update.message.document:
+            document = update.message.document
+            if not document.file_name or not document.file_name.lower().endswith(('.csv', '.json')):
+                await update.message.reply_text("❌ Поддерживаются только файлы .csv и .json")
+                return
+            if document.file_size and document.file_size > BULK_IMPORT_MAX_BYTES:
+                await update.message.reply_text("❌ Файл слишком большой")
+                return
+            file = await document.get_file()
+            data = bytes(await file.download_as_bytearray())
+            try:
+                rows, rejected = parse_episode_document(document.file_name, data)
+            except (ValueError, TypeError, csv.Error) as e:
+                await update.message.reply_text(f"❌ Не удалось разобрать файл: {str(e)}")
+                return
+            await receive_episode_batch(update, context, anime_id, rows, rejected)
+            return
+        
+        if update.message.text and len(update.message.text.strip().splitlines()) > 1:
+            rows, rejected = parse_episode_lines(update.message.text)
+            await receive_episode_batch(update, context, anime_id, rows, rejected)
+            return
+        
         if update.message.video:
             # Если прислали видеофайл
             if not update.message.caption:
@@ -443,8 +2927,9 @@ async def receive_episode_data(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
                 
             episode_number = int(update.message.caption)
-            video_file = await update.message.video.get_file()
-            video_url = video_file.file_path  # Прямая ссылка на видео в Telegram
+            # file_id постоянный, в отличие от file_path, который со временем истекает
+            file_id = update.message.video.file_id
+            video_url = file_id
         else:
             # Если прислали текст с ссылкой
             data = update.message.text.split('|')
@@ -458,9 +2943,16 @@ async def receive_episode_data(update: Update, context: ContextTypes.DEFAULT_TYP
             
             episode_number = int(data[0].strip())
             video_url = data[1].strip()
+            file_id = None
+            if TELEGRAM_FILE_URL in video_url:
+                await update.message.reply_text(
+                    "❌ Ссылка на файл Telegram содержит токен бота и быстро истекает. "
+                    "Пришлите само видео с номером серии в подписи:"
+                )
+                return
         
         # Сохраняем в базу
-        add_episode(anime_id, episode_number, video_url)
+        await add_episode(anime_id, episode_number, video_url, file_id)
         await update.message.reply_text(
             f"✅ Серия {episode_number} успешно добавлена!"
         )
@@ -470,39 +2962,66 @@ async def receive_episode_data(update: Update, context: ContextTypes.DEFAULT_TYP
     except ValueError:
         await update.message.reply_text("❌ Номер серии должен быть числом")
     except Exception as e:
-        logger.error(f"Ошибка в функции receive_episode_data: {str(e)}")
+        logger.error("Ошибка в функции receive_episode_data: %s", e)
         await update.message.reply_text(f"⚠️ Ошибка при добавлении серии: {str(e)}")
 
+async def receive_episode_batch(update, context, anime_id, rows, rejected):
+    inserted, updated = [], []
+    if rows:
+        inserted, updated = await import_episodes(anime_id, rows)
+    await update.message.reply_text(
+        format_import_report(inserted, updated, rejected),
+        parse_mode="HTML"
+    )
+    if not rows:
+        return
+    
+    del context.user_data['selected_anime_id']
+    await admin_command(update, context)
+
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     try:
-        if not is_admin(query.from_user.id):
+        if not await is_admin(query.from_user.id):
             await query.edit_message_text("🚫 Доступ запрещен")
             return
         
-        with get_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) FROM anime")
-                anime_count = cursor.fetchone()[0]
-                
-                cursor.execute("SELECT COUNT(*) FROM episodes")
-                episodes_count = cursor.fetchone()[0]
-                
-                cursor.execute("SELECT COUNT(*) FROM users WHERE is_admin = TRUE")
-                admins_count = cursor.fetchone()[0]
+        stats = await get_stats()
+        dau, wau = await get_active_users()
+        anime_count = stats.get('anime', 0)
+        episodes_count = stats.get('episodes', 0)
+        per_title = episodes_count / anime_count if anime_count else 0
+        
+        newest_anime = ", ".join(html.escape(title) for title in stats['newest_anime']) or "—"
+        newest_episodes = ", ".join(
+            f"{html.escape(title)} #{number}" for title, number in stats['newest_episodes']
+        ) or "—"
         
         stats_text = (
             "📊 <b>Статистика бота</b>\n\n"
             f"• 🎌 Аниме в базе: <b>{anime_count}</b>\n"
-            f"• 🎬 Серий в базе: <b>{episodes_count}</b>\n"
-            f"• 👑 Администраторов: <b>{admins_count}</b>"
+            f"• 🎬 Серий в базе: <b>{episodes_count}</b> "
+            f"(в среднем <b>{per_title:.1f}</b> на аниме)\n"
+            f"• 👑 Администраторов: <b>{stats.get('admins', 0)}</b>\n"
+            f"• 👥 Пользователей: <b>{stats.get('users', 0)}</b>, "
+            f"активных за сутки: <b>{dau}</b>, за неделю: <b>{wau}</b>\n"
+            f"• 🆕 Новые аниме: {newest_anime}\n"
+            f"• 🆕 Новые серии: {newest_episodes}\n\n"
+            f"• 🗂 Кэш каталога: <b>{catalog_cache.hits}</b> попаданий / "
+            f"<b>{catalog_cache.misses}</b> промахов "
+            f"({catalog_cache.hit_ratio:.0%})\n"
+            f"• 🔐 Проверки прав из памяти: <b>{admin_cache.hit_ratio:.0%}</b> "
+            f"(загрузок из БД: <b>{admin_cache.refreshes}</b>)\n"
+            f"• 🔔 Уведомлений отправлено: <b>{broadcaster.sent}</b>, "
+            f"ошибок: <b>{broadcaster.failed}</b>, повторов: <b>{broadcaster.retries}</b> "
+            f"({broadcaster.throughput:.1f} сообщ./с)"
         )
         
         await query.edit_message_text(stats_text, parse_mode="HTML")
     except Exception as e:
-        logger.error(f"Ошибка в функции admin_stats: {str(e)}")
+        logger.error("Ошибка в функции admin_stats: %s", e)
         await query.edit_message_text("⚠️ Произошла ошибка при загрузке статистики")
 
 async def admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -510,46 +3029,458 @@ async def admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     await admin_command(update, context)
 
+# ===================== Хранилище состояния диалогов =====================
+def _save_user_state(conn, rows, deleted):
+    with conn.cursor() as cursor:
+        if rows:
+            _execute_values(
+                cursor,
+                "INSERT INTO user_state (user_id, data, updated_at) VALUES {values} "
+                "ON CONFLICT (user_id) DO UPDATE "
+                "SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at",
+                rows, template="(%s, %s, CURRENT_TIMESTAMP)"
+            )
+        if deleted:
+            cursor.execute(
+                f"DELETE FROM user_state WHERE user_id IN ({_placeholders(len(deleted))})",
+                deleted
+            )
+
+class PostgresPersistence(BasePersistence):
+    """Хранит user_data (состояние админских диалогов) в таблице user_state.
+
+    Данные кэшируются в памяти самим Application, а изменения, которые он
+    передаёт раз в update_interval, записываются одним пакетным запросом.
+    В режиме shared состояние администраторов записывается сразу после
+    каждого их обновления и перечитывается перед следующим, чтобы несколько
+    экземпляров бота видели общие данные; обновления обычных пользователей
+    БД не трогают. Несохранённые локальные изменения при перечитывании не
+    затираются.
+    """
+
+    def __init__(self, update_interval, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.shared = shared
+        self._stored = set()
+        self._pending = {}
+        # Последнее состояние, совпадающее с БД (только в режиме shared)
+        self._synced = {}
+        self._flush_task = None
+
+    async def get_user_data(self):
+        try:
+            await prepare_database()
+            rows = await db.fetchall("SELECT user_id, data FROM user_state")
+        except DB_UNAVAILABLE_ERRORS as e:
+            # Без БД бот работает только на чтение — незаконченные диалоги не нужны
+            logger.error("❌ Состояние диалогов не загружено, БД недоступна: %s", e)
+            return {}
+        except Exception as e:
+            logger.error("❌ Ошибка инициализации БД: %s", e)
+            raise
+        self._stored = {user_id for user_id, data in rows}
+        if self.shared:
+            self._synced = {user_id: json.loads(data) for user_id, data in rows}
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def update_user_data(self, user_id, data):
+        if not data and user_id not in self._stored and user_id not in self._pending:
+            return
+        self._pending[user_id] = data
+        # Application вызывает update_user_data для всех изменённых пользователей
+        # подряд — собираем их в одну запись
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.shared:
+            return
+        # Изменения, ещё не записанные в БД (например, запись не удалась), важнее
+        if user_data != self._synced.get(user_id, {}):
+            return
+        try:
+            if not await admin_cache.contains(user_id):
+                return
+            row = await db.fetchone("SELECT data FROM user_state WHERE user_id = %s", (user_id,))
+        except DB_UNAVAILABLE_ERRORS:
+            return
+        user_data.clear()
+        if row:
+            self._stored.add(user_id)
+            user_data.update(json.loads(row[0]))
+        self._synced[user_id] = json.loads(row[0]) if row else {}
+
+    async def write_through(self, user_id, user_data):
+        """В режиме shared сразу сохраняет изменённое состояние пользователя."""
+        if not self.shared or user_data == self._synced.get(user_id, {}):
+            return
+        self._pending[user_id] = dict(user_data)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("Ошибка при сохранении состояния пользователя %s: %s", user_id, e)
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("Ошибка при сохранении состояния пользователей: %s", e)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        rows = [(user_id, json.dumps(data)) for user_id, data in pending.items() if data]
+        deleted = [user_id for user_id, data in pending.items() if not data]
+        try:
+            await db.run(_save_user_state, rows, deleted)
+        except Exception:
+            for user_id, data in pending.items():
+                self._pending.setdefault(user_id, data)
+            raise
+        self._stored.update(user_id for user_id, data in rows)
+        self._stored.difference_update(deleted)
+        if self.shared:
+            self._synced.update((user_id, json.loads(data)) for user_id, data in rows)
+            for user_id in deleted:
+                self._synced.pop(user_id, None)
+
+    # Остальные данные не сохраняются
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+def build_persistence():
+    if PERSISTENCE_BACKEND == 'postgres':
+        return PostgresPersistence(PERSISTENCE_INTERVAL, shared=PERSISTENCE_SHARED)
+    if PERSISTENCE_BACKEND == 'pickle':
+        # Локальный файл: переживает перезапуск, но не делится между экземплярами
+        return PicklePersistence(
+            PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=PERSISTENCE_INTERVAL
+        )
+    return None
+
+# ===================== Обработка обновлений =====================
+# Нажатий кнопок в секунду на пользователя и запас для коротких серий (0 — без ограничения)
+CALLBACK_RATE = float(os.getenv('CALLBACK_RATE', '2'))
+CALLBACK_BURST = int(os.getenv('CALLBACK_BURST', '5'))
+# Для скольких пользователей хранить счётчики нажатий
+CALLBACK_MAX_USERS = 10000
+
+CALLBACKS_DROPPED = metrics.register(Counter(
+    'bot_callbacks_dropped_total', 'Отброшенные нажатия кнопок', 'reason'
+))
+
+class CallbackThrottle:
+    """Фильтр нажатий кнопок перед CallbackQueryHandler.
+
+    Повторное нажатие той же кнопки, пока первое ещё обрабатывается или ждёт
+    очереди, отбрасывается. Остальные нажатия ограничиваются токен-бакетом
+    на пользователя. На отброшенное нажатие бот только отвечает
+    query.answer(), чтобы у пользователя пропали «часики».
+    """
+
+    def __init__(self, rate, burst, max_users):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._in_flight = set()
+        self._buckets = OrderedDict()
+
+    def _bucket(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def admit(self, query):
+        """None, если нажатие принято, иначе причина отказа: duplicate или rate."""
+        key = (query.from_user.id, query.data)
+        if key in self._in_flight:
+            CALLBACKS_DROPPED.inc('duplicate')
+            return 'duplicate'
+        if self.rate and not self._bucket(query.from_user.id).try_acquire():
+            CALLBACKS_DROPPED.inc('rate')
+            return 'rate'
+        self._in_flight.add(key)
+        return None
+
+    def release(self, query):
+        self._in_flight.discard((query.from_user.id, query.data))
+
+    async def reject(self, query, reason):
+        try:
+            if reason == 'rate':
+                await query.answer("⏳ Слишком часто, подождите секунду")
+            else:
+                await query.answer()
+        except Exception as e:
+            logger.debug("Не удалось ответить на отброшенное нажатие: %s", e)
+
+callback_throttle = CallbackThrottle(CALLBACK_RATE, CALLBACK_BURST, CALLBACK_MAX_USERS)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей выполняются одновременно (не более
+    max_concurrent_updates рабочих слотов), обновления одного пользователя —
+    строго по очереди. Семафор BaseUpdateProcessor практически не ограничен:
+    ожидающие своей очереди обновления не занимают ни рабочих слотов, ни мест
+    в общем лимите, поэтому один активный пользователь не блокирует
+    остальных. Нажатия кнопок проходят через throttle сразу при получении,
+    до ожидания очереди пользователя.
+    """
+
+    # Общий лимит BaseUpdateProcessor; параллельность задаёт только self._workers
+    PENDING_LIMIT = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates, throttle=None):
+        super().__init__(self.PENDING_LIMIT)
+        self.workers = max_concurrent_updates
+        self.throttle = throttle
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        query = update.callback_query if isinstance(update, Update) else None
+        if query is None or self.throttle is None or query.from_user is None:
+            await self._process(update, coroutine)
+            return
+        reason = self.throttle.admit(query)
+        if reason is not None:
+            coroutine.close()
+            await self.throttle.reject(query, reason)
+            return
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self.throttle.release(query)
+
+    async def _process(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        # [lock, число ожидающих]: запись удаляется, когда очередь пользователя пуста
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._locks.clear()
+
 # ===================== Главная функция =====================
-def main():
+_recovery_task = None
+
+async def _load_from_database():
+    await prepare_database()
+    await admin_cache.refresh()
+    await search_index.load()
+
+async def _wait_for_database():
+    """Повторяет инициализацию, пока бот работает из снимка каталога."""
+    global _recovery_task
+    while True:
+        await asyncio.sleep(DB_BREAKER_RESET)
+        try:
+            await _load_from_database()
+        except DB_UNAVAILABLE_ERRORS:
+            continue
+        except Exception as e:
+            logger.error("❌ Ошибка инициализации БД: %s", e)
+            continue
+        logger.info("✅ База данных доступна, режим только для чтения выключен")
+        _recovery_task = None
+        return
+
+async def on_startup(application: Application):
+    global _recovery_task
     # Инициализация базы данных с обработкой ошибок
     try:
-        init_db()
-        logger.info("✅ Бот запускается...")
+        await _load_from_database()
+    except DB_UNAVAILABLE_ERRORS as e:
+        # Не выходим: каталог доступен из снимка, БД подключится, когда вернётся
+        logger.error("❌ БД недоступна, бот работает только на чтение: %s", e)
+        if not await catalog_snapshot.ensure_loaded():
+            logger.warning("⚠️ Снимка каталога нет — каталог недоступен до восстановления БД")
+        _recovery_task = asyncio.create_task(_wait_for_database())
     except Exception as e:
-        logger.error(f"❌ Ошибка инициализации БД: {e}")
-        sys.exit(1)
+        logger.error("❌ Ошибка инициализации БД: %s", e)
+        raise
+    catalog_snapshot.start()
+    activity_tracker.start()
+    watch_history.start()
+    broadcaster.start(application.bot)
+    cover_sender.start(application.bot)
+    await metrics_server.start()
+    logger.info("✅ Бот запускается...")
+
+async def on_shutdown(application: Application):
+    await metrics_server.stop()
+    if _recovery_task is not None:
+        _recovery_task.cancel()
+    await catalog_snapshot.stop()
+    await cover_sender.stop()
+    await broadcaster.stop()
+    try:
+        await activity_tracker.stop()
+    except Exception as e:
+        logger.error("Ошибка при сохранении активности пользователей: %s", e)
+    try:
+        await watch_history.stop()
+    except Exception as e:
+        logger.error("Ошибка при сохранении истории просмотров: %s", e)
+    await asyncio.to_thread(db.close)
+
+def build_application():
+    """Создаёт приложение со всеми обработчиками (используется и в бенчмарках)."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Пул как у PTB по умолчанию; запросы getUpdates идут отдельным клиентом
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, callback_throttle))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    persistence = build_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    application = builder.build()
     
-    # Создание приложения
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Учёт активности: выполняется перед остальными обработчиками и не мешает им
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
     
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("search", search_command))
     application.add_handler(CommandHandler("auth", admin_auth))
     application.add_handler(CommandHandler("admin", admin_command))
     
+    # Инлайн-поиск (@бот <название>)
+    application.add_handler(InlineQueryHandler(inline_search))
+    
     # Обработчики CallbackQuery
     application.add_handler(CallbackQueryHandler(anime_details, pattern="^anime_"))
     application.add_handler(CallbackQueryHandler(watch_episode, pattern="^episode_"))
+    application.add_handler(CallbackQueryHandler(toggle_subscription_handler, pattern=r"^sub_\d+$"))
     application.add_handler(CallbackQueryHandler(back_to_menu, pattern="^back_to_menu$"))
+    application.add_handler(CallbackQueryHandler(menu_page, pattern=r"^menu_(next|prev)_\d+$"))
+    application.add_handler(CallbackQueryHandler(episodes_page, pattern=r"^eps_\d+_(next|prev)_-?\d+$"))
     
     # Админ-панель
     application.add_handler(CallbackQueryHandler(admin_command, pattern="^admin_panel$"))
     application.add_handler(CallbackQueryHandler(add_anime_handler, pattern="^admin_add_anime$"))
     application.add_handler(CallbackQueryHandler(add_episode_handler, pattern="^admin_add_episode$"))
+    application.add_handler(CallbackQueryHandler(add_episode_handler, pattern=r"^admin_list_(next|prev)_\d+$"))
     application.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
     application.add_handler(CallbackQueryHandler(select_anime_for_episode, pattern="^admin_episode_"))
     application.add_handler(CallbackQueryHandler(admin_cancel, pattern="^admin_cancel$"))
     
     # Обработчики сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, receive_anime_data))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, receive_episode_data))
+    # В одной группе срабатывает только первый подходящий обработчик,
+    # поэтому текст для серии обрабатывается в отдельной группе
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, receive_episode_data), group=1)
     application.add_handler(MessageHandler(filters.VIDEO, receive_episode_data))
+    application.add_handler(MessageHandler(filters.Document.ALL, receive_episode_data))
+    
+    # Общее состояние нескольких экземпляров: сохраняется после всех обработчиков
+    if isinstance(persistence, PostgresPersistence) and persistence.shared:
+        application.add_handler(TypeHandler(Update, persist_shared_state), group=2)
+    
+    # Замер длительности каждого обработчика для /metrics
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    return application
+
+def main():
+    application = build_application()
     
     # Запуск бота
     logger.info("✅ Бот запущен и ожидает сообщений...")
-    application.run_polling()
+    try:
+        if BOT_MODE == 'webhook':
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET
+            )
+        else:
+            application.run_polling()
+    except Exception:
+        logger.exception("❌ Бот остановлен из-за ошибки")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()